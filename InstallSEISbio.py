@@ -18,12 +18,42 @@ import sys
 import argparse
 import re
 import getpass
+import time
+import json
+import hashlib
+import platform
+import threading
+import shutil
+import fcntl
+import stat
+import tarfile
+import bz2
+import tempfile
+import sqlite3
+import difflib
+import logging
+from logging.handlers import RotatingFileHandler
+from collections import deque
+from contextlib import contextmanager, nullcontext
 from subprocess import run
+from subprocess import Popen
 from subprocess import PIPE
+from subprocess import DEVNULL
+from subprocess import STDOUT
 from subprocess import check_output
 from subprocess import TimeoutExpired
 from subprocess import CalledProcessError
 from pathlib import Path
+try:
+    import yaml
+except ImportError:
+    yaml = None
+from urllib.request import urlopen
+from urllib.request import Request
+from urllib.error import HTTPError
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from concurrent.futures import FIRST_COMPLETED
 # TODO (acph) add time tolerance to subprocess functoins
 # TODO (acph) ... and catch TimeoutExpired
 # TODO (acph) catch CalledProcessError ? it is necessary
@@ -37,9 +67,352 @@ from pathlib import Path
 # TODO (acph) create external scripts for installing some programas
 
 
+class StageError(Exception):
+    """A provisioning stage finished with errors"""
+
+
+JOURNAL_LOCK = threading.Lock()
+
+# Downloaded bytes of the last fetch_url of each URL
+FETCH_BYTES = {}
+
+# Steps recorded by profile_step, the disk sizes are only measured when
+# profiling is enabled (--profile)
+PROFILE = {'enabled': False, 'steps': []}
+PROFILE_LOCK = threading.Lock()
+
+# Settings of run_logged: live progress lines (--progress), lines shown on
+# failure (--tail) and size of the rotating step logs
+RUNNER = {'progress': False, 'tail': 40, 'interval': 10,
+          'max_bytes': 50 * 2**20, 'backups': 3}
+
+# Read-only stores of a local installation (--local): the package caches
+# and lockfile stores of the system wide installation. The manager links
+# the packages found there and downloads only the missing ones into the
+# own cache. softlink: symlink the files instead of hardlinking them.
+SHARED = {'pkgs': [], 'locks': [], 'softlink': False}
+
+# Parent directory of the distribution homes (--home-root). Benchmarks and
+# tests install in a temporary directory.
+HOME_ROOT = '/home'
+
+
+def log_dir(home):
+    """Directory of the step logs, /home/<home>/.seisbio/logs"""
+    path = Path(f'{HOME_ROOT}/{home}')/'.seisbio'/'logs'
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def run_logged(cmd, logfile, step=None, env=None, uid=None, timeout=None,
+               check=True, append=False, cwd=None):
+    """Runs cmd streaming its output (stdout and stderr) line by line to a
+    rotating log file. Only the last RUNNER['tail'] lines are kept in
+    memory, they are printed if the command fails.
+
+    Keyword Arguments:
+    logfile -- log file path, rotated every RUNNER['max_bytes']
+    step    -- str, name of the step in the progress and error messages
+    uid     -- run as this user (see demote)
+    timeout -- seconds, the process is killed after them
+    check   -- bool (default True)
+               Raise CalledProcessError if the exit status is not 0
+    append  -- bool (default False)
+               Append to logfile instead of starting it again
+
+    Returns
+    -------
+    out : int, exit status
+    """
+    step = step or Path(logfile).stem
+    if not append and os.path.exists(logfile):
+        os.remove(logfile)
+    handler = RotatingFileHandler(logfile, maxBytes=RUNNER['max_bytes'],
+                                  backupCount=RUNNER['backups'])
+    handler.emit(logging.makeLogRecord({'msg': '$ ' + ' '.join(cmd)}))
+    tail = deque(maxlen=RUNNER['tail'])
+    state = {'lines': 0, 'shown': time.time()}
+    proc = Popen(cmd, stdout=PIPE, stderr=STDOUT, env=env, cwd=cwd,
+                 **as_user(uid))
+
+    def reader():
+        # bounded reads, progress bars without newlines can be huge
+        for raw in iter(lambda: proc.stdout.readline(1 << 16), b''):
+            line = raw.decode(errors='replace').rstrip()
+            handler.emit(logging.makeLogRecord({'msg': line}))
+            tail.append(line)
+            state['lines'] += 1
+            now = time.time()
+            if RUNNER['progress'] and now - state['shown'] > RUNNER['interval']:
+                state['shown'] = now
+                print(f"[RUNNING] {step}: {state['lines']} lines | "
+                      f"{line[:70]}")
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    try:
+        returncode = proc.wait(timeout=timeout)
+    except TimeoutExpired:
+        proc.kill()
+        proc.wait()
+        # grandchildren may keep the pipe open
+        thread.join(timeout=5)
+        handler.close()
+        print_tail(step, tail, logfile, f'timeout after {timeout}s')
+        raise TimeoutExpired(cmd, timeout, output='\n'.join(tail))
+    thread.join()
+    handler.close()
+    if returncode != 0 and check:
+        print_tail(step, tail, logfile, f'exit status {returncode}')
+        raise CalledProcessError(returncode, cmd, output='\n'.join(tail))
+    return returncode
+
+
+def print_tail(step, tail, logfile, reason):
+    """Prints the last lines of a failed step"""
+    print(f'[FAILED] {step} ({reason}), last {len(tail)} lines of {logfile}:')
+    for line in tail:
+        print(f'    | {line}')
+
+
+def locks_dir(home):
+    """Directory of the lock files of a distribution home"""
+    path = Path(f'{HOME_ROOT}/{home}')/'.seisbio'/'locks'
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def pkgs_env(myenv, pkgs_dir):
+    """Sets the package caches of the manager in myenv, pkgs_dir (the only
+    one written) and then the SHARED read-only caches. Returns myenv."""
+    myenv['CONDA_PKGS_DIRS'] = ','.join([str(pkgs_dir)] + SHARED['pkgs'])
+    if SHARED['softlink']:
+        myenv['CONDA_ALWAYS_SOFTLINK'] = 'true'
+    return myenv
+
+
+def pid_alive(pid):
+    """True if a process with pid exists in this machine"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+@contextmanager
+def file_lock(path, shared=False, label=None):
+    """Inter-process (and inter-thread) lock on a file with flock.
+
+    Exclusive locks write their holder (pid, host, time) in the file. The
+    kernel releases the lock of a dead process, a holder record of a dead
+    process found when the lock is taken is reported as stale. Shared
+    locks only wait for exclusive ones.
+
+    Yields True if the lock was held by somebody else and had to be
+    waited, the caller may reuse what the other holder did.
+    """
+    path = Path(path)
+    if not path.parent.is_dir():
+        path.parent.mkdir(parents=True, exist_ok=True)
+    label = label or path.name
+    # shared locks of other users files (see system_cache_lock)
+    readonly = shared and path.exists() and not os.access(path, os.W_OK)
+    with open(path, 'r' if readonly else 'a+') as lockf:
+        mode = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        waited = False
+        try:
+            fcntl.flock(lockf, mode | fcntl.LOCK_NB)
+        except BlockingIOError:
+            waited = True
+            print(f'[WAIT] {label} is locked by {lock_holder(path)}')
+            fcntl.flock(lockf, mode)
+        try:
+            if not shared:
+                holder = lock_holder(path)
+                if holder and holder.get('host') == platform.node() and \
+                   not pid_alive(holder.get('pid', 0)):
+                    print(f"[WARN] Stale lock {label} of dead process "
+                          f"{holder['pid']}, taking it over")
+                lockf.seek(0)
+                lockf.truncate()
+                json.dump({'pid': os.getpid(), 'host': platform.node(),
+                           'time': time.time()}, lockf)
+                lockf.flush()
+            yield waited
+        finally:
+            if not shared:
+                lockf.seek(0)
+                lockf.truncate()
+                lockf.flush()
+            fcntl.flock(lockf, fcntl.LOCK_UN)
+
+
+def lock_holder(path):
+    """Holder record of an exclusive file_lock, None if it is free"""
+    try:
+        return json.loads(Path(path).read_text())
+    except (OSError, ValueError):
+        return None
+
+
+def cache_lock(home, distribution, shared=True, manager='mamba'):
+    """Lock of the distribution package cache. Installs take it shared,
+    the operations that remove packages from the cache exclusive.
+
+    Concurrent installs of the same packages are coordinated by the
+    manager: libmamba locks each package of the cache while it is
+    downloaded and extracted and the other installs wait and reuse it.
+    conda only does it with its experimental lock feature, so the conda
+    installs take the lock exclusive, one at a time (see manager_jobs).
+    """
+    return file_lock(locks_dir(home)/f'pkgs-{distribution}.lock',
+                     shared=shared and manager != 'conda',
+                     label=f'{distribution} package cache')
+
+
+def system_cache_lock(home, distribution):
+    """Shared lock of the package cache of the system wide installation
+    taken by a local installation while it links from it. It is only
+    read, a nullcontext if the system installation has no lock file."""
+    path = (Path(f'{HOME_ROOT}/{home}')/'.seisbio'/'locks'/
+            f'pkgs-{distribution}.lock')
+    if not os.access(path, os.R_OK):
+        return nullcontext(False)
+    return file_lock(path, shared=True,
+                     label=f'system {distribution} package cache')
+
+
+def env_lock(home, envname):
+    """Exclusive lock of one environment (and of 'base')"""
+    return file_lock(locks_dir(home)/f'env-{envname}.lock',
+                     label=f'environment {envname}')
+
+
+@contextmanager
+def profile_step(step, **info):
+    """Records the wall time and exit status of the step in PROFILE.
+
+    The yielded dict can be updated with more fields (bytes, disk...).
+    CalledProcessError and TimeoutExpired set the exit status, the
+    exceptions are not catched.
+    """
+    record = {'step': step, 'exit': 0}
+    record.update(info)
+    start = time.time()
+    try:
+        yield record
+    except CalledProcessError as err:
+        record['exit'] = err.returncode
+        raise
+    except TimeoutExpired:
+        record['exit'] = 'timeout'
+        raise
+    except Exception as err:
+        record['exit'] = type(err).__name__
+        raise
+    finally:
+        record['seconds'] = round(time.time() - start, 3)
+        with PROFILE_LOCK:
+            PROFILE['steps'].append(record)
+
+
+def disk_usage(path):
+    """Bytes used by the regular files under path, hardlinks counted once.
+    Returns None when profiling is disabled."""
+    if not PROFILE['enabled']:
+        return None
+    total = 0
+    seen = set()
+    for root, dirs, files in os.walk(path):
+        for fname in files:
+            try:
+                st = os.lstat(os.path.join(root, fname))
+            except OSError:
+                continue
+            if not stat.S_ISREG(st.st_mode) or (st.st_dev, st.st_ino) in seen:
+                continue
+            seen.add((st.st_dev, st.st_ino))
+            total += st.st_size
+    return total
+
+
+def pkgs_tarballs(pkgs_dir):
+    """Returns a dict with the package tarballs (*.conda, *.tar.bz2) in the
+    package cache -> size. Used to measure the downloaded bytes."""
+    tarballs = {}
+    if not PROFILE['enabled'] or not os.path.isdir(pkgs_dir):
+        return tarballs
+    for entry in os.scandir(pkgs_dir):
+        if entry.name.endswith(('.conda', '.tar.bz2')):
+            tarballs[entry.name] = entry.stat().st_size
+    return tarballs
+
+
+def downloaded_bytes(before, pkgs_dir):
+    """Bytes of the new tarballs in the package cache since before (see
+    pkgs_tarballs). With parallel envs the count is approximate, a tarball
+    is counted by the first env that sees it."""
+    after = pkgs_tarballs(pkgs_dir)
+    return sum(size for name, size in after.items() if name not in before)
+
+
+def write_profile(home):
+    """Writes the JSON report of the recorded steps and prints a summary
+    sorted by wall time.
+
+    Returns
+    -------
+    out : Path of the report, /home/<home>/.seisbio/reports/profile-*.json
+    """
+    if not Path(f'{HOME_ROOT}/{home}').exists():
+        print(f'[WARN] /home/{home} does not exist, no profile report')
+        return None
+    report_dir = Path(f'{HOME_ROOT}/{home}')/'.seisbio'/'reports'
+    report_dir.mkdir(parents=True, exist_ok=True)
+    stamp = time.strftime('%Y%m%d-%H%M%S')
+    report = {'created': time.time(),
+              'host': platform.node(),
+              'steps': PROFILE['steps']}
+    path = report_dir/f'profile-{stamp}.json'
+    path.write_text(json.dumps(report, indent=1))
+    print('[PROFILE] Slowest steps')
+    print(f"    {'seconds':>9} {'exit':>7} {'MB down':>8} {'MB disk':>8}  step")
+    for rec in sorted(PROFILE['steps'], key=lambda r: r['seconds'],
+                      reverse=True):
+        down = rec.get('bytes')
+        disk = rec.get('disk')
+        down = '-' if down is None else f'{down / 1e6:.1f}'
+        disk = '-' if disk is None else f'{disk / 1e6:.1f}'
+        print(f"    {rec['seconds']:9.1f} {str(rec['exit']):>7} "
+              f"{down:>8} {disk:>8}  {rec['step']}")
+    print(f'[PROFILE] Report: {path}')
+    return path
+
+
 def arguments():
     """Argument parser function"""
     parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('command', nargs='?', default='install',
+                        choices=['install', 'lock-list', 'lock-evict',
+                                 'export', 'deploy', 'check', 'compact',
+                                 'update', 'verify', 'materialize'],
+                        help='install: install SEISbio [default]. '
+                        'lock-list: show the solved environments lockfile '
+                        'store. lock-evict: remove lockfiles older than '
+                        '--max-age days. export: pack the installed '
+                        'distribution and envs in --artifacts. deploy: '
+                        'unpack --artifacts in --target. check: validate '
+                        'the env file against the channels repodata. '
+                        'compact: hardlink identical files of all the envs '
+                        'and remove the package tarballs. update: update '
+                        'only the envs (and base) with newer versions of '
+                        'their packages in the channels repodata. verify: '
+                        'smoke test the entry point of every env. '
+                        'materialize: install the --env envs (all without '
+                        '--env) recorded by --lazy.')
     parser.add_argument('-d', '--distribution', default='miniforge',
                         choices=['miniforge', 'miniconda'],
                         help='Select scientific software distribution.')
@@ -47,7 +420,10 @@ def arguments():
                         help='User and home directory to create for the '
                         'distribution installation. [seisbio]'
                         'This will be created in /home/')
-    parser.add_argument('--homeid', default=1015,
+    parser.add_argument('--home-root', default='/home',
+                        help='Parent directory of the distribution home. '
+                        '[/home]')
+    parser.add_argument('--homeid', default=1015, type=int,
                         help='Distribution user UID and GUID. [1015]')
     parser.add_argument('--debian', default=False, action='store_true',
                         help='Install basic and bioinformatic packages from '
@@ -55,7 +431,20 @@ def arguments():
                         'are specified in the dev directory in SEISbio root '
                         'directory.')
     parser.add_argument('--debupgrade', action='store_true', default=False,
-                        help='If specified  UPDATE Debian/ubuntu system')
+                        help='If specified  UPDATE Debian/ubuntu system '
+                        '(or ArchLinux with --arch)')
+    parser.add_argument('--arch', default=False, action='store_true',
+                        help='Install basic and bioinformatic packages from '
+                        'ArchLinux repositories and AUR. The lists of '
+                        'packages are specified in the arch directory in '
+                        'SEISbio root directory.')
+    parser.add_argument('--aur-dir', default=None,
+                        help='arch: directory with a <package>/PKGBUILD '
+                        'for each AUR package, used instead of AUR.')
+    parser.add_argument('--aur-cache', default=None,
+                        help='arch: built AUR packages cache, share it to '
+                        'build each PKGBUILD version once for many nodes. '
+                        '[/home/<home>/.seisbio/aur/pkgs]')
     parser.add_argument('-f', '--envfile', default='virtual_envs.txt',
                         help=('Files that specifies the virtual environments'
                               'to create in SEISbio instalation.'
@@ -63,26 +452,140 @@ def arguments():
                               'the file specification in ./virtual_envs.txt'))
     parser.add_argument('--local', default=False, action='store_true',
                         help='Prefers a local installation instead of a system'
-                        ' wide isntallation. Does not needs root access.')
+                        ' wide isntallation. Does not needs root access. '
+                        'The package cache, lockfiles and installer of the '
+                        'system wide installation of --home are reused '
+                        'read-only, only the missing packages are '
+                        'downloaded.')
+    parser.add_argument('--softlink', default=False, action='store_true',
+                        help='local: symlink the files of the system package '
+                        'cache instead of hardlinking (or copying) them. '
+                        'Almost no disk use, the envs depend on the system '
+                        'cache.')
+    parser.add_argument('-j', '--jobs', default=1, type=int,
+                        help='Number of virtual environments created at the '
+                        'same time. [1]')
+    parser.add_argument('--refresh-locks', default=False, action='store_true',
+                        help='Solve the environments again instead of '
+                        'installing them from the lockfile store and '
+                        'replace the stored lockfiles.')
+    parser.add_argument('--prune', default=False, action='store_true',
+                        help='Remove the SEISbio environments (*-env) that '
+                        'are not in the env file.')
+    parser.add_argument('--resume', default=False, action='store_true',
+                        help='Continue the last run from its first unfinished'
+                        ' stage and environment, reusing its answers. The '
+                        'journal is kept in /home/<home>/.seisbio/.')
+    parser.add_argument('--mirror', default=None,
+                        help='Base URL (http(s):// or file://) used instead '
+                        'of the official location to download the '
+                        'distribution installer.')
+    parser.add_argument('--download-cache', default=None,
+                        help='Download cache directory. Use a shared '
+                        'directory to download the installer once for '
+                        'many machines. [/home/<home>/.seisbio/downloads]')
+    parser.add_argument('--installer-sha256', default=None,
+                        help='Expected SHA-256 of the installer. By default '
+                        'the published <installer>.sha256 file is used.')
+    parser.add_argument('--profile', default=False, action='store_true',
+                        help='Measure the disk size of the distribution and '
+                        'envs and write a JSON performance report of every '
+                        'step (wall time, exit status, downloaded bytes) in '
+                        '/home/<home>/.seisbio/reports/.')
+    parser.add_argument('--progress', default=False, action='store_true',
+                        help='Show the progress of the running steps. The '
+                        'complete output is always in the step logs in '
+                        '/home/<home>/.seisbio/logs/.')
+    parser.add_argument('--tail', default=40, type=int,
+                        help='Output lines shown when a step fails. [40]')
+    parser.add_argument('--artifacts', default='seisbio-artifacts',
+                        help='Directory of the export/deploy archives and '
+                        'manifest. [./seisbio-artifacts]')
+    parser.add_argument('--target', default=None,
+                        help='deploy destination prefix, local directory or '
+                        'rsync host:/path. [/home/<home>/<distribution>]')
+    parser.add_argument('--activation', default='conda',
+                        choices=['conda', 'static'],
+                        help='Shell activation. conda: conda initialize '
+                        'block in /etc/bash.bashrc. static: precomputed '
+                        'snippets, activate-seis <env> and command shims, '
+                        'no python process in each shell. [conda]')
+    parser.add_argument('--lazy', default=False, action='store_true',
+                        help='Do not install the envs, record them and write '
+                        'command shims that install each env on its first '
+                        'call. Implies --activation static.')
+    parser.add_argument('--env', action='append', default=[],
+                        help='materialize: env to install, can be repeated.')
+    parser.add_argument('--templates', default=False, action='store_true',
+                        help='Create the envs with a lockfile that share '
+                        'many packages as hardlinked clones of a template '
+                        'env plus their extra packages.')
+    parser.add_argument('--prefetch', default=False, action='store_true',
+                        help='Download the packages of all the envs (and '
+                        'base), each distinct package once, before creating'
+                        ' them.')
+    parser.add_argument('--fetch-jobs', default=8, type=int,
+                        help='prefetch: packages downloaded at the same '
+                        'time. [8]')
+    parser.add_argument('--verify', default=False, action='store_true',
+                        help='Smoke test the entry point of every env after '
+                        'installing them, see the verify command.')
+    parser.add_argument('--preflight', default=False, action='store_true',
+                        help='Validate the env file against the channels '
+                        'repodata before installing anything.')
+    parser.add_argument('--channel-alias', default=None,
+                        help='Base URL of the channels for the repodata '
+                        'index, file:// for a local mirror. '
+                        '[https://conda.anaconda.org]')
+    parser.add_argument('--offline', default=False, action='store_true',
+                        help='Use the repodata index as it is, without '
+                        'downloading the channels not indexed yet.')
+    parser.add_argument('--refresh-index', default=False,
+                        action='store_true',
+                        help='check, --preflight: refresh the repodata of '
+                        'the channels already indexed. By default only the '
+                        'new channels are downloaded (update always '
+                        'refreshes).')
+    parser.add_argument('--dry-run', default=False, action='store_true',
+                        help='compact, update: only report what would be '
+                        'done.')
+    parser.add_argument('--plan', default=False, action='store_true',
+                        help='Print the installation stages graph and exit.'
+                        ' Stages with the same level run at the same time.')
+    parser.add_argument('--timeout', default=600, type=int,
+                        help='Timeout in seconds of each distribution '
+                        'update, base install and environment. [600]')
+    parser.add_argument('--max-age', default=30, type=float,
+                        help='Age in days of the lockfiles removed by '
+                        'lock-evict. 0 removes all of them. [30]')
     # TODO(acph) Select instalation path
     # TODO(acph) Select local or systemwide isntalation
+    # system wide home of a local installation, see main
+    parser.set_defaults(shared_home=None)
     args = parser.parse_args()
     return args
 
-## TODO Arch
-## --noconfirm
 
-def debian_install_bioinfo(upgrade=False):
+def debian_install_bioinfo(upgrade=False, logs=None):
     """Installing bioinfo basic packages from Debian/Ubuntu repositories.
     WARNING: Only for debian/ubuntu
 
-    1. Update
-    2. Upgrade
-    3. Install basic programs (emacs, vim, lm-sensors, htop, aptitude)
-    4. Bioinfo software
+    1. Update (only with upgrade)
+    2. Basic programs (emacs, vim, lm-sensors, htop, aptitude) and
+       bioinfo software missing in the system, in one apt transaction.
+       With upgrade the transaction also upgrades the system.
+
+    apt is not called at all when every package is installed and no
+    upgrade is requested.
+
+    The apt output goes to <logs>/debian-*.log (default /var/log/seisbio).
+    As before, apt errors do not stop the installation.
     """
-    cmd_update = ['apt', 'update']
-    cmd_upgrade = ['apt', 'upgrade', '-y']
+    logs = Path(logs or '/var/log/seisbio')
+    logs.mkdir(parents=True, exist_ok=True)
+    myenv = os.environ.copy()
+    # apt output is logged, nobody can answer debconf questions
+    myenv['DEBIAN_FRONTEND'] = 'noninteractive'
     # reading package lists
     basic_file = Path(__file__).parent.absolute()/'deb/basic_pkgs.txt'
     bioinfo_file = Path(__file__).parent.absolute()/'deb/bioinfo_pkgs.txt'
@@ -90,20 +593,323 @@ def debian_install_bioinfo(upgrade=False):
     basic_pkgs = read_env_file(basic_file)
     bioinfo_pkgs = read_env_file(bioinfo_file)
     #
-    cmd_basic = ['apt', 'install', '-y'] + basic_pkgs
-    cmd_bioinfo = ['apt', 'install', '-y'] + bioinfo_pkgs
+    installed = dpkg_installed()
+    missing = [pkg for pkg in dict.fromkeys(basic_pkgs + bioinfo_pkgs)
+               if pkg not in installed]
+    print(f'[INFO] {len(missing)} Debian/Ubuntu packages missing')
+    if not missing and not upgrade:
+        print('[INFO] Nothing to install from repositories (Debian/Ubuntu)')
+        return
 
     if upgrade:
         print('[INFO] Updating and upgrading system (Debian/Ubuntu)')
-        run(cmd_update)
-        run(cmd_upgrade)
+        with profile_step('debian:update') as record:
+            record['exit'] = run_logged(['apt', 'update'],
+                                        logs/'debian-update.log',
+                                        env=myenv, check=False)
+        # apt upgrade also installs the packages given as arguments
+        cmd = ['apt', 'upgrade', '-y'] + missing
+    else:
+        cmd = ['apt', 'install', '-y'] + missing
+
+    print('''[INFO] Installing helping packages and Bioinformatic programs
+             from repositories (Debian/Ubuntu)''')
+    with profile_step('debian:install', packages=len(missing)) as record:
+        record['exit'] = run_logged(cmd, logs/'debian-install.log',
+                                    env=myenv, check=False)
+
+
+def dpkg_installed():
+    """Returns the set of installed Debian/Ubuntu packages, and the virtual
+    packages they provide, with a single dpkg-query call"""
+    fmt = '${Package}\t${db:Status-Abbrev}\t${Provides}\n'
+    proc = run(['dpkg-query', '-W', '-f=' + fmt], stdout=PIPE,
+               stderr=DEVNULL)
+    installed = set()
+    for line in proc.stdout.decode(errors='replace').splitlines():
+        fields = line.split('\t')
+        if len(fields) < 2 or not fields[1].startswith('ii'):
+            continue
+        installed.add(fields[0])
+        if len(fields) > 2 and fields[2]:
+            for provided in fields[2].split(','):
+                installed.add(provided.split()[0])
+    return installed
+
+
+# AUR git repositories, <AUR_URL>/<package>.git
+AUR_URL = 'https://aur.archlinux.org'
+
+
+def arch_install_bioinfo(upgrade=False, logs=None, home='seisbio', uid=1015,
+                         jobs=1, aur_dir=None, cache_dir=None):
+    """Installing basic and bioinfo packages in ArchLinux, from the
+    repositories (arch/arch_pks.txt) and from AUR (arch/aur_pks.txt).
+    WARNING: Only for ArchLinux
+
+    1. One pacman query (pacman -T) of the missing packages.
+    2. The missing repository packages, with the repository dependencies
+       of the AUR packages, in one pacman --noconfirm --needed
+       transaction. With upgrade the transaction also upgrades the system.
+       The dependencies only in AUR that are not listed are reported, they
+       are not in the transaction (see pacman_sync_known).
+    3. The missing AUR packages are built at the same time (jobs) with
+       makepkg as the distribution user and installed with one pacman -U
+       transaction. AUR packages that need other AUR packages wait for
+       them (see aur_levels).
+
+    Built packages are kept in cache_dir by PKGBUILD version (see
+    aur_build), a rebuild or another node using the same cache installs
+    them without building.
+
+    Keyword Arguments:
+    aur_dir   -- str (default None)
+                 Directory with a <package>/PKGBUILD directory for each AUR
+                 package, used instead of cloning them from AUR.
+    cache_dir -- str (default /home/<home>/.seisbio/aur/pkgs)
+                 Built packages cache, can be shared by many nodes.
+
+    As with Debian, pacman errors do not stop the installation.
+    """
+    logs = Path(logs or '/var/log/seisbio')
+    logs.mkdir(parents=True, exist_ok=True)
+    lists = Path(__file__).parent.absolute()/'arch'
+    repo_pkgs = read_env_file(lists/'arch_pks.txt')
+    aur_pkgs = read_env_file(lists/'aur_pks.txt')
+    missing = pacman_missing(repo_pkgs + aur_pkgs)
+    repo_missing = [pkg for pkg in repo_pkgs if pkg in missing]
+    aur_missing = [pkg for pkg in aur_pkgs if pkg in missing]
+    print(f'[INFO] {len(repo_missing)} ArchLinux and {len(aur_missing)} AUR '
+          'packages missing')
+    if not missing and not upgrade:
+        print('[INFO] Nothing to install from repositories (ArchLinux)')
+        return
+    build_dir = Path(f'{HOME_ROOT}/{home}')/'.seisbio'/'aur'/'build'
+    cache_dir = Path(cache_dir or
+                     Path(f'{HOME_ROOT}/{home}')/'.seisbio'/'aur'/'pkgs')
+    for path in (build_dir, cache_dir):
+        path.mkdir(parents=True, exist_ok=True)
+        chown_user(path, uid)
+    srcinfos = {}
+    if aur_missing:
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            srcinfos = dict(zip(aur_missing, pool.map(
+                lambda pkg: aur_source(pkg, build_dir, uid=uid,
+                                       aur_dir=aur_dir, logs=logs),
+                aur_missing)))
+        srcinfos = {pkg: info for pkg, info in srcinfos.items() if info}
+    # repository dependencies of the AUR packages, in the same transaction
+    provided = {name for info in srcinfos.values()
+                for name in info['pkgname'] + info['provides']}
+    deps = [dep for info in srcinfos.values()
+            for dep in info['depends'] + info['makedepends']
+            if dep_name(dep) not in provided]
+    deps = list(pacman_missing(list(dict.fromkeys(deps))))
+    # an AUR only dependency would make pacman abort the whole transaction
+    # (target not found)
+    known = pacman_sync_known(deps)
+    aur_deps = sorted(dep for dep in deps if dep not in known)
+    deps = [dep for dep in deps if dep in known]
+    if aur_deps:
+        print(f"[WARN] Missing AUR dependencies: {', '.join(aur_deps)}. "
+              'Add them to arch/aur_pks.txt, the AUR packages that need '
+              'them will fail to build')
+    if upgrade:
+        print('[INFO] Updating and upgrading system (ArchLinux)')
+        cmd = ['pacman', '-Syu', '--noconfirm', '--needed']
+    else:
+        cmd = ['pacman', '-S', '--noconfirm', '--needed']
+    if repo_missing or deps or upgrade:
+        print('[INFO] Installing helping packages and Bioinformatic programs '
+              'from repositories (ArchLinux)')
+        with profile_step('arch:install', packages=len(repo_missing),
+                          deps=len(deps)) as record:
+            record['exit'] = run_logged(cmd + repo_missing + deps,
+                                        logs/'arch-install.log',
+                                        check=False)
+    for level in aur_levels(srcinfos):
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            built = list(pool.map(
+                lambda pkg: aur_build(pkg, srcinfos[pkg], build_dir,
+                                      cache_dir, uid=uid, logs=logs),
+                level))
+        artifacts = [str(path) for paths in built for path in paths]
+        if not artifacts:
+            continue
+        print(f'[INFO] Installing {len(artifacts)} AUR packages')
+        with profile_step('aur:install', packages=len(artifacts)) as record:
+            record['exit'] = run_logged(['pacman', '-U', '--noconfirm',
+                                         '--needed'] + artifacts,
+                                        logs/'aur-install.log', check=False,
+                                        append=True)
+
+
+def pacman_missing(pkgs):
+    """Returns the set of pkgs (names or dependencies like name>=1.0) that
+    are not installed or provided, with a single pacman -T call"""
+    if not pkgs:
+        return set()
+    with profile_step('arch:query', packages=len(pkgs)):
+        proc = run(['pacman', '-T'] + pkgs, stdout=PIPE, stderr=DEVNULL)
+    return set(proc.stdout.decode(errors='replace').split())
+
+
+def pacman_sync_known(deps):
+    """Returns the set of deps (names or dependencies like name>=1.0) that
+    the sync repositories have or provide: one pacman -Slq for the package
+    names, pacman -Sp for the ones only provided by other packages."""
+    if not deps:
+        return set()
+    with profile_step('arch:sync-query', packages=len(deps)):
+        proc = run(['pacman', '-Slq'], stdout=PIPE, stderr=DEVNULL)
+        names = set(proc.stdout.decode(errors='replace').split())
+        known = set()
+        for dep in deps:
+            if dep_name(dep) in names or run(
+                    ['pacman', '-Sp', '--print-format', '%n', dep],
+                    stdout=DEVNULL, stderr=DEVNULL).returncode == 0:
+                known.add(dep)
+    return known
+
+
+def dep_name(dep):
+    """Package name of a dependency, python>=3.9 -> python"""
+    return re.split('[<>=:]', dep, maxsplit=1)[0]
+
+
+def parse_srcinfo(text):
+    """Fields of a .SRCINFO as lists: pkgbase, pkgname, pkgver, pkgrel,
+    epoch, provides, depends and makedepends (with the ones of this
+    machine architecture)"""
+    fields = {key: [] for key in ('pkgbase', 'pkgname', 'pkgver', 'pkgrel',
+                                  'epoch', 'provides', 'depends',
+                                  'makedepends')}
+    machine = platform.machine()
+    for line in text.splitlines():
+        key, sep, value = line.strip().partition(' = ')
+        if not sep:
+            continue
+        key = key.rsplit(f'_{machine}', 1)[0]
+        if key in fields and value not in fields[key]:
+            fields[key].append(value)
+    fields['provides'] = [dep_name(dep) for dep in fields['provides']]
+    return fields
+
+
+def aur_version(info):
+    """Full version of a parsed .SRCINFO, [epoch:]pkgver-pkgrel"""
+    epoch = f"{info['epoch'][0]}:" if info['epoch'] else ''
+    return f"{epoch}{info['pkgver'][0]}-{info['pkgrel'][0]}"
 
-    print('[INFO] Installing helping packages (Debian/Ubuntu)')
-    run(cmd_basic)
 
-    print('''[INFO] Installing Bioinformatic programs from repositories
-             (Debian/Ubuntu)''')
-    run(cmd_bioinfo)
+def aur_source(pkg, build_dir, uid=1015, aur_dir=None, logs=None):
+    """Gets the PKGBUILD of pkg in build_dir/pkg, a copy of
+    aur_dir/pkg or a git clone (pull if it exists) of the AUR, and
+    returns its parsed .SRCINFO (None if it fails)"""
+    dest = Path(build_dir)/pkg
+    try:
+        if aur_dir:
+            shutil.rmtree(dest, ignore_errors=True)
+            shutil.copytree(Path(aur_dir)/pkg, dest, symlinks=True)
+            chown_tree(dest, uid)
+        elif (dest/'.git').is_dir():
+            run_logged(['git', '-C', str(dest), 'pull', '--ff-only'],
+                       Path(logs)/f'aur-{pkg}.log', uid=uid)
+        else:
+            run_logged(['git', 'clone', '--depth', '1',
+                        f'{AUR_URL}/{pkg}.git', str(dest)],
+                       Path(logs)/f'aur-{pkg}.log', uid=uid)
+        if (dest/'.SRCINFO').exists():
+            text = (dest/'.SRCINFO').read_text()
+        else:
+            text = check_output(['makepkg', '--printsrcinfo'], cwd=dest,
+                                **as_user(uid),
+                                stderr=PIPE).decode()
+    except (OSError, CalledProcessError, TimeoutExpired) as err:
+        print(f'[WARN] No PKGBUILD for AUR package {pkg}: {err}')
+        return None
+    info = parse_srcinfo(text)
+    if not info['pkgver'] or not info['pkgrel']:
+        print(f'[WARN] AUR package {pkg} has no version, not built')
+        return None
+    return info
+
+
+def aur_levels(srcinfos):
+    """Groups the AUR packages in build levels, the packages of a level
+    only depend on packages of previous levels (or on no AUR package)"""
+    provides = {name: pkg for pkg, info in srcinfos.items()
+                for name in info['pkgname'] + info['provides']}
+    needs = {pkg: {provides[dep_name(dep)]
+                   for dep in info['depends'] + info['makedepends']
+                   if dep_name(dep) in provides} - {pkg}
+             for pkg, info in srcinfos.items()}
+    levels, done = [], set()
+    while len(done) < len(needs):
+        level = [pkg for pkg in needs if pkg not in done
+                 and needs[pkg] <= done]
+        if not level:
+            # dependency cycle, build the rest at once
+            level = [pkg for pkg in needs if pkg not in done]
+        levels.append(level)
+        done.update(level)
+    return levels
+
+
+def aur_build(pkg, info, build_dir, cache_dir, uid=1015, logs=None):
+    """Builds pkg with makepkg as uid, unless cache_dir already has the
+    packages of this PKGBUILD version, cache_dir/<pkgbase>/<version>-<arch>.
+
+    The packages are built in a temporary directory renamed into the
+    cache when makepkg ends, the cache entry is locked while it is built
+    (see file_lock) so a node building it makes the others wait.
+
+    Returns
+    -------
+    out : list of Paths of the built (or cached) packages, empty if the
+          build failed
+    """
+    base = (info['pkgbase'] or info['pkgname'] or [pkg])[0]
+    version = aur_version(info)
+    entry = Path(cache_dir)/base/f'{version}-{platform.machine()}'
+    entry.parent.mkdir(parents=True, exist_ok=True)
+    chown_user(entry.parent, uid)
+
+    def artifacts():
+        return sorted(entry.glob('*.pkg.tar*')) if entry.is_dir() else []
+
+    with file_lock(entry.parent/'.lock', label=f'AUR {base}'):
+        if artifacts():
+            print(f'[CACHED] {base} {version}')
+            return artifacts()
+        tmp = Path(tempfile.mkdtemp(prefix=f'.{version}-', dir=entry.parent))
+        chown_user(tmp, uid)
+        myenv = os.environ.copy()
+        myenv['PKGDEST'] = str(tmp)
+        print(f'[BUILDING] {base} {version}')
+        try:
+            with profile_step(f'aur:{base}', version=version):
+                run_logged(['makepkg', '--noconfirm', '--cleanbuild', '-f'],
+                           Path(logs)/f'aur-{pkg}.log', step=f'aur:{base}',
+                           env=myenv, uid=uid, cwd=Path(build_dir)/pkg,
+                           append=True)
+        except CalledProcessError:
+            shutil.rmtree(tmp, ignore_errors=True)
+            print(f'[FAILED] AUR package {base}, see {logs}/aur-{pkg}.log')
+            return []
+        os.rename(tmp, entry)
+    print(f'[OK] {base} {version}')
+    return artifacts()
+
+
+def as_user(uid):
+    """Popen arguments to run a command as the user uid, group uid and no
+    supplementary groups. preexec_fn (see demote) is not safe with the
+    threads of the jobs pool. Empty if the process already is the user
+    (local installation) or uid is None."""
+    if uid is None or os.getuid() == uid:
+        return {}
+    return {'user': uid, 'group': uid, 'extra_groups': []}
 
 
 def demote(user_uid, user_gid):
@@ -113,11 +919,22 @@ def demote(user_uid, user_gid):
     user_gid = int(user_gid)
 
     def set_ids():
+        if os.getuid() == user_uid:
+            # already the user, local installation
+            return
         os.setgid(user_gid)
         os.setuid(user_uid)
     return set_ids
 
 
+def chown_user(path, uid):
+    """Gives path to the user (group uid, see demote). Nothing to do if the
+    process already is the user, local installation: its primary group
+    may not be uid."""
+    if os.getuid() != uid:
+        os.chown(path, uid, uid)
+
+
 def check_id_as_user():
     """Run the command 'id' in a subprocess as user 1010,
     return the result
@@ -130,25 +947,197 @@ def check_id_as_user():
     return check_output(cmd, preexec_fn=demote(1015, 1015))
 
 
-def donwload_distribution(distribution='miniforge', uid='1015', home='seisbio'):
+DIST_URLS = {'miniforge':
+             'https://github.com/conda-forge/miniforge/releases/latest/download/Miniforge3-Linux-x86_64.sh',
+             'miniconda':
+             'https://repo.anaconda.com/miniconda/Miniconda3-latest-Linux-x86_64.sh'}
+
+
+def installer_filename(distribution='miniforge'):
+    """Installer file name of the distribution"""
+    return DIST_URLS[distribution].split('/')[-1]
+
+
+def donwload_distribution(distribution='miniforge', uid='1015', home='seisbio',
+                          mirror=None, cache_dir=None, sha256=None):
     """Downloads the latest installator from the scientific distribution
 to isntall.
 
+    The installer goes through the download cache (see fetch_url) and is
+    copied to the distribution home only after its SHA-256 is verified.
+
     Keyword Arguments:
     distribution -- str (default 'miniforge')
              'miniaforge' | 'miniconda'
+    mirror    -- str (default None)
+             Base URL (http(s):// or file://) with the installers, it
+             replaces the official download location.
+    cache_dir -- str (default /home/<home>/.seisbio/downloads)
+             Download cache, use a shared directory to download the
+             installer once for many machines.
+    sha256    -- str (default None)
+             Expected checksum. By default the <url>.sha256 file published
+             with the installer is used when it exists.
     """
-    urls = {'miniforge':
-            'https://github.com/conda-forge/miniforge/releases/latest/download/Miniforge3-Linux-x86_64.sh',
-            'miniconda':
-            'https://repo.anaconda.com/miniconda/Miniconda3-latest-Linux-x86_64.sh'}
-    url = urls[distribution]
-    cmd = ['wget', '-N', url, '-P', '/home/'+home]
-    check_output(cmd, preexec_fn=demote(uid, uid), stderr=PIPE)
-    filename = url.split('/')[-1]
+    filename = installer_filename(distribution)
+    url = DIST_URLS[distribution]
+    if mirror:
+        url = mirror.rstrip('/') + '/' + filename
+    if cache_dir is None:
+        cache_dir = Path(f'{HOME_ROOT}/{home}')/'.seisbio'/'downloads'
+    if sha256 is None:
+        sha256 = fetch_sha256(url + '.sha256')
+        if sha256 is None:
+            print(f'[WARN] No checksum for {url}, it will not be verified')
+    with profile_step('download') as record:
+        cached = fetch_url(url, cache_dir, sha256=sha256)
+        record['bytes'] = FETCH_BYTES[url]
+    # copy to the home, same name as wget -N
+    dest = Path(f'{HOME_ROOT}/{home}')/filename
+    tmp = dest.with_name(filename + '.tmp')
+    shutil.copyfile(cached, tmp)
+    chown_user(tmp, uid)
+    os.replace(tmp, dest)
     return filename
 
 
+class DownloadError(StageError):
+    """A download failed or its checksum does not match"""
+
+
+def file_sha256(fname):
+    """SHA-256 hex digest of a file"""
+    digest = hashlib.sha256()
+    with open(fname, 'rb') as inf:
+        for block in iter(lambda: inf.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def fetch_sha256(url):
+    """Returns the checksum of a .sha256 file ('<hex>  <filename>') or None
+    if it does not exist"""
+    try:
+        with urlopen(url, timeout=60) as response:
+            text = response.read(4096).decode()
+    except (OSError, ValueError):
+        return None
+    fields = text.split()
+    if fields and re.fullmatch('[0-9a-fA-F]{64}', fields[0]):
+        return fields[0].lower()
+    return None
+
+
+def fetch_url(url, cache_dir, sha256=None, retries=3):
+    """Downloads url into the cache directory and returns the cached Path.
+    The cache entry is locked (see file_lock), a download started by
+    another process is waited for and reused. See fetch_url_unlocked.
+    """
+    key = hashlib.sha256(url.encode()).hexdigest()[:16]
+    fname = url.split('/')[-1]
+    Path(cache_dir).mkdir(parents=True, exist_ok=True)
+    with file_lock(Path(cache_dir)/f'{key}-{fname}.lock', label=fname):
+        return fetch_url_unlocked(url, cache_dir, sha256=sha256,
+                                  retries=retries)
+
+
+def fetch_url_unlocked(url, cache_dir, sha256=None, retries=3):
+    """Downloads url into the cache directory and returns the cached Path.
+
+    - Entries are keyed by URL, the metadata (.json) keeps the ETag,
+      Last-Modified and SHA-256 of the file.
+    - Cached files are revalidated with a conditional request, a 304 (or
+      the same Last-Modified for file:// URLs) does not download again.
+    - Partial downloads (.part) are resumed with a Range request.
+    - The file is verified against sha256 (or the cached checksum)
+      before it replaces the cache entry; a mismatch raises DownloadError.
+
+    Returns
+    -------
+    out : Path of the verified file in the cache.
+          The number of downloaded bytes is kept in FETCH_BYTES[url].
+    """
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    key = hashlib.sha256(url.encode()).hexdigest()[:16]
+    fname = url.split('/')[-1]
+    path = cache_dir/f'{key}-{fname}'
+    part = cache_dir/f'{key}-{fname}.part'
+    metafile = cache_dir/f'{key}-{fname}.json'
+    try:
+        meta = json.loads(metafile.read_text())
+    except (OSError, ValueError):
+        meta = {}
+    if not path.exists():
+        meta = {}
+    if sha256 is not None and meta.get('sha256') not in (None, sha256):
+        # a new release behind the same URL
+        meta = {}
+    FETCH_BYTES[url] = 0
+    for attempt in range(1, retries + 1):
+        headers = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        elif meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        offset = part.stat().st_size if part.exists() else 0
+        if offset:
+            headers['Range'] = f'bytes={offset}-'
+        try:
+            with urlopen(Request(url, headers=headers),
+                         timeout=60) as response:
+                status = response.status or 200
+                etag = response.headers.get('ETag')
+                modified = response.headers.get('Last-Modified')
+                if meta and modified and modified == meta.get('last_modified')\
+                   and etag == meta.get('etag'):
+                    # file:// and servers ignoring conditional requests
+                    status = 304
+                if status == 304:
+                    break
+                mode = 'ab' if status == 206 else 'wb'
+                with open(part, mode) as out:
+                    for block in iter(lambda: response.read(1 << 20), b''):
+                        out.write(block)
+                        FETCH_BYTES[url] += len(block)
+        except HTTPError as err:
+            if err.code == 304:
+                break
+            if err.code == 416:
+                # Range not satisfiable, the part is complete or stale
+                part.unlink()
+                continue
+            print(f'[WARN] Download of {url} failed ({err}), '
+                  f'attempt {attempt}')
+            continue
+        except OSError as err:
+            print(f'[WARN] Download of {url} interrupted ({err}), '
+                  f'attempt {attempt}')
+            continue
+        digest = file_sha256(part)
+        if sha256 is not None and digest != sha256:
+            part.unlink()
+            raise DownloadError(f'Checksum mismatch for {url}: '
+                                f'{digest} != {sha256}')
+        os.replace(part, path)
+        meta = {'url': url, 'etag': etag, 'last_modified': modified,
+                'sha256': digest, 'size': path.stat().st_size}
+        metafile.write_text(json.dumps(meta, indent=1))
+        return path
+    else:
+        raise DownloadError(f'Could not download {url} after '
+                            f'{retries} attempts')
+    # not modified, the cached file must still be intact
+    if file_sha256(path) != meta.get('sha256'):
+        path.unlink()
+        metafile.unlink()
+        return fetch_url_unlocked(url, cache_dir, sha256=sha256,
+                                  retries=retries)
+    if part.exists():
+        part.unlink()
+    return path
+
+
 def install_distribution(installer, distribution='miniforge', home='seisbio', uid=1015):
     """Downloads the latest installator from the scientific distribution
 to isntall.
@@ -158,233 +1147,2550 @@ to isntall.
              'miniforge' | 'miniconda'
     """
     myenv = os.environ.copy()
-    myenv['HOME'] = f'/home/{home}'
+    myenv['HOME'] = f'{HOME_ROOT}/{home}'
     # run(['echo', '$HOME'])
     # se podra ejecutar con sudo esta parte?
     # INSTALL
-    cmd = ['bash', f'/home/{home}/{installer}', '-b',
-           '-p', f'/home/{home}/{distribution}']
-    check_output(cmd, preexec_fn=demote(uid, uid), env=myenv)
+    cmd = ['bash', f'{HOME_ROOT}/{home}/{installer}', '-b',
+           '-p', f'{HOME_ROOT}/{home}/{distribution}']
+    with env_lock(home, 'base'), profile_step('install') as record:
+        run_logged(cmd, log_dir(home)/'install.log', uid=uid, env=myenv)
+        record['disk'] = disk_usage(f'{HOME_ROOT}/{home}/{distribution}')
     # init conda, [WARN]
-    cmd_init = [f'/home/{home}/{distribution}/bin/conda', 'init']
-    check_output(cmd_init, preexec_fn=demote(uid, uid), env=myenv)
+    cmd_init = [f'{HOME_ROOT}/{home}/{distribution}/bin/conda', 'init']
+    with profile_step('install:init'):
+        run_logged(cmd_init, log_dir(home)/'install-init.log', uid=uid,
+                   env=myenv)
 
 
 def update_distribution(manager='mamba', distribution='miniforge',
-                        home='seisbio', uid=1015):
+                        home='seisbio', uid=1015, timeout=600):
     """Update miniconda installation
+
+    A full `update --all` of base, only when the base update is answered
+    yes. The targeted updates of plan_updates (update command) need the
+    repodata index of conda-forge, minutes and GBs to build, and a base
+    fresh from the installer needs the managers and all their
+    dependencies updated together anyway.
     """
-    os.chdir(f'/home/{home}/')
     myenv = os.environ.copy()
-    myenv['HOME'] = f'/home/{home}'
-    cmd = [f'/home/{home}/{distribution}/bin/{manager}',
+    myenv['HOME'] = f'{HOME_ROOT}/{home}'
+    pkgs_env(myenv, f'{HOME_ROOT}/{home}/{distribution}/pkgs')
+    cmd = [f'{HOME_ROOT}/{home}/{distribution}/bin/{manager}',
            'update',
            '-p',
-           f'/home/{home}/{distribution}',
+           f'{HOME_ROOT}/{home}/{distribution}',
            '-y',
            '--all',
            '-q']
-    check_output(cmd, preexec_fn=demote(uid, uid), env=myenv,
-                 stderr=PIPE, timeout=600)
+    pkgs_dir = f'{HOME_ROOT}/{home}/{distribution}/pkgs'
+    before = pkgs_tarballs(pkgs_dir)
+    with cache_lock(home, distribution, manager=manager), \
+            env_lock(home, 'base'), profile_step('update') as record:
+        run_logged(cmd, log_dir(home)/'update.log', uid=uid, env=myenv,
+                   timeout=timeout, cwd=f'{HOME_ROOT}/{home}/')
+        record['bytes'] = downloaded_bytes(before, pkgs_dir)
+
+
+# TODO pasar esto a un archivo
+BASE_PKGS = ['numpy',
+             'scipy',
+             'matplotlib',
+             'pandas',
+             'statsmodels',
+             'seaborn',
+             'biopython',
+             'scikit-learn',
+             'scikit-image',
+             'networkx',
+             'jupyter',
+             # These two are graphical interfase programs
+             # 'spyder',
+             # 'orange3',
+             'tensorflow',
+             'keras',
+             'jupyterlab',
+             'jupyter-lsp',
+             'jupyterlab-lsp',
+             'jupyter-lsp-python',
+             # TODO Separeate by protgramming language ??
+             # R packages
+             'r-base',
+             'r-tidyverse',
+             'r-irkernel',
+             'jupyter-lsp-r',
+             'radian'
+             ]
+
+# Base URL of the conda channels (repodata index)
+CHANNEL_ALIAS = 'https://conda.anaconda.org'
+
+# Default channels of each distribution, only used for the lock cache keys
+DIST_CHANNELS = {'miniforge': ['conda-forge'],
+                 'miniconda': ['defaults']}
 
 
 def install_distribution_base(manager='mamba',
                               distribution='miniforge',
-                              home='seisbio', uid=1015):
-    """Completing miniconda base environment with scientific packages"""
-    os.chdir(f'/home/{home}/')
+                              home='seisbio', uid=1015,
+                              refresh_locks=False, timeout=600):
+    """Completing miniconda base environment with scientific packages.
+
+    When the lock cache has an explicit lockfile for BASE_PKGS the packages
+    are installed from it without solving. Otherwise the solved base is
+    stored in the cache for the next run. The lockfile is a snapshot of the
+    whole base, so its key includes the installed base packages: a base
+    changed by the update stage gets a new solve instead of going back to
+    the old snapshot.
+    """
+    with cache_lock(home, distribution, manager=manager), \
+            env_lock(home, 'base'):
+        install_base_locked(manager=manager, distribution=distribution,
+                            home=home, uid=uid, refresh_locks=refresh_locks,
+                            timeout=timeout)
+
+
+def base_spec(distribution='miniforge', home='seisbio', uid=1015, env=None):
+    """Spec of the BASE_PKGS install with the state of the installed base
+    (sha256 of its packages, see conda_list), see lock_key"""
+    installed = conda_list(f'{HOME_ROOT}/{home}/{distribution}',
+                           distribution=distribution, home=home, uid=uid,
+                           env=env)
+    state = json.dumps(installed, sort_keys=True)
+    return {'name': 'base', 'packages': BASE_PKGS,
+            'channels': DIST_CHANNELS[distribution],
+            'state': hashlib.sha256(state.encode()).hexdigest()}
+
+
+def install_base_locked(manager='mamba', distribution='miniforge',
+                        home='seisbio', uid=1015, refresh_locks=False,
+                        timeout=600):
+    """install_distribution_base with the base and cache locks taken"""
     myenv = os.environ.copy()
-    myenv['HOME'] = f'/home/{home}'
-    # TODO pasar esto a un archivo
-    cmd = [f'/home/{home}/{distribution}/bin/{manager}',
-           'install',
-           '-p',
-           f'/home/{home}/{distribution}',
-           '-y',
-           '-q',
-           'numpy',
-           'scipy',
-           'matplotlib',
-           'pandas',
-           'statsmodels',
-           'seaborn',
-           'biopython',
-           'scikit-learn',
-           'scikit-image',
-           'networkx',
-           'jupyter',
-           # These two are graphical interfase programs
-           #'spyder',
-           #'orange3',
-           'tensorflow',
-           'keras',
-           'jupyterlab',
-           'jupyter-lsp',
-           'jupyterlab-lsp',
-           'jupyter-lsp-python',
-           # TODO Separeate by protgramming language ??
-           # R packages
-           'r-base',
-           'r-tidyverse',
-           'r-irkernel',
-           'jupyter-lsp-r',
-           'radian'
-           ]
-    check_output(cmd, preexec_fn=demote(uid, uid), env=myenv,
-                 stderr=PIPE, timeout=600)
+    myenv['HOME'] = f'{HOME_ROOT}/{home}'
+    prefix = f'{HOME_ROOT}/{home}/{distribution}'
+    manager_path = f'{prefix}/bin/{manager}'
+    pkgs_dir = f'{prefix}/pkgs'
+    pkgs_env(myenv, pkgs_dir)
+    spec = base_spec(distribution=distribution, home=home, uid=uid,
+                     env=myenv)
+    lockfile = None if refresh_locks else lock_lookup(home, spec)
+    if lockfile is not None:
+        print(f'[INFO] Installing base packages from {lockfile}')
+        cmd = [manager_path, 'install', '-p', prefix, '-y', '-q',
+               '--file', str(lockfile)]
+        before = pkgs_tarballs(pkgs_dir)
+        try:
+            with profile_step('base', lock='hit') as record:
+                run_logged(cmd, log_dir(home)/'base.log', uid=uid,
+                           env=myenv, timeout=timeout,
+                           cwd=f'{HOME_ROOT}/{home}/')
+                record['bytes'] = downloaded_bytes(before, pkgs_dir)
+                record['disk'] = disk_usage(prefix)
+            return
+        except CalledProcessError:
+            print(f'[WARN] Lockfile {lockfile} failed, solving again')
+            lock_evict(lockfile)
+    cmd = [manager_path, 'install', '-p', prefix, '-y', '-q'] + BASE_PKGS
+    before = pkgs_tarballs(pkgs_dir)
+    with profile_step('base', lock='miss') as record:
+        run_logged(cmd, log_dir(home)/'base.log', uid=uid, env=myenv,
+                   timeout=timeout, append=lockfile is not None,
+                   cwd=f'{HOME_ROOT}/{home}/')
+        record['bytes'] = downloaded_bytes(before, pkgs_dir)
+        record['disk'] = disk_usage(prefix)
+    lock_store(home, spec, prefix, distribution=distribution,
+               env=myenv, uid=uid)
 
 
-def install_virtual_envs(pkg_list, manager='mamba',
-                         distribution='miniforge',
-                         home='seisbio', uid=1015):
-    """Installing virtual environments for many bioinformatics programs from:
-    - conda-forge
-    - bioconda
-    - Other repositories
+def conda_platform():
+    """Returns the conda subdir of this machine, i.e. linux-64"""
+    system = {'Linux': 'linux', 'Darwin': 'osx'}.get(platform.system(),
+                                                     platform.system().lower())
+    machine = platform.machine()
+    if machine in ('x86_64', 'AMD64'):
+        arch = '64'
+    elif machine == 'arm64':
+        arch = 'arm64'
+    else:
+        arch = machine
+    return f'{system}-{arch}'
+
+
+def lock_key(spec, subdir=None):
+    """Content address of a solved environment: sha256 of the package
+    specification, the channel list (order matters), the platform and the
+    installed state the spec is solved on (spec 'state', only base)"""
+    subdir = subdir or conda_platform()
+    content = {'packages': sorted(spec['packages']),
+               'channels': list(spec['channels']),
+               'platform': subdir}
+    if spec.get('state'):
+        content['state'] = spec['state']
+    content = json.dumps(content, sort_keys=True)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def lock_dir(home):
+    """Directory of the lockfile store"""
+    return Path(f'{HOME_ROOT}/{home}')/'.seisbio'/'lockcache'
+
+
+def lock_lookup(home, spec):
+    """Returns the lockfile Path for spec or None if it is not cached.
+    The SHARED lockfile stores are looked up after the own store."""
+    for ldir in [lock_dir(home)] + [Path(d) for d in SHARED['locks']]:
+        lockfile = ldir/(lock_key(spec) + '.txt')
+        if os.access(lockfile, os.R_OK):
+            return lockfile
+    return None
+
+
+def lock_store(home, spec, prefix, distribution='miniforge', env=None,
+               uid=1015):
+    """Stores the explicit package list of prefix as the lockfile of spec.
+    The lockfile is written with `conda list --explicit --md5` and a
+    sidecar .json file with the spec and the creation time.
     """
-    # paths
-    manager_path = f'/home/{home}/{distribution}/bin/{manager}'
-    home_path = f'/home/{home}/'
-    # basic config
-    os.chdir(home_path)
-    myenv = os.environ.copy()
-    myenv['HOME'] = home_path
-    env_info = check_output([manager_path, 'info', '--env']).decode()
-    # env_info = run([manager_path, 'info',  '--env'], stdout=PIPE)
-    # env_info = env_info.stdout.decode()
-    base_cmd = manager_path + ' create -n {} -c bioconda -c conda-forge {} -y -q'
-    for pkg in pkg_list:
-        if '=' in pkg:
-            pkname, version = pkg.split('=')
-            version = version.replace('.', '')
-            envname = pkname + version + '-env'
-        else:
-            envname = pkg + '-env'
-        if envname not in env_info:
-            print('[INSTALLING]', 'Environmet for', envname, 'package')
-            # ###
-            # CONDITIONALs for independent packages cases, lets try to avoid this
-            if 'hicexplorer' in envname:
-                pkgs = pkg + ' hic2cool'
-                cmd = base_cmd.format(envname, pkgs)
-            elif 'snakePipes' in pkg:
-                cmd = base_cmd.format('snakePipes -c mpi-ie', 'snakePipes')
+    ldir = lock_dir(home)
+    ldir.mkdir(parents=True, exist_ok=True)
+    key = lock_key(spec)
+    conda_path = f'{HOME_ROOT}/{home}/{distribution}/bin/conda'
+    try:
+        explicit = check_output([conda_path, 'list', '--explicit', '--md5',
+                                 '-p', prefix],
+                                **as_user(uid), env=env,
+                                stderr=PIPE).decode()
+    except CalledProcessError:
+        print(f"[WARN] Could not store the lockfile of {spec['name']}")
+        return None
+    meta = {'name': spec['name'],
+            'packages': list(spec['packages']),
+            'channels': list(spec['channels']),
+            'platform': conda_platform(),
+            'created': time.time()}
+    lockfile = ldir/(key + '.txt')
+    tmp = ldir/(key + '.txt.tmp')
+    tmp.write_text(explicit)
+    (ldir/(key + '.json')).write_text(json.dumps(meta, indent=1))
+    os.replace(tmp, lockfile)
+    return lockfile
+
+
+def lock_evict(lockfile):
+    """Removes a lockfile and its metadata from the store"""
+    lockfile = Path(lockfile)
+    if not os.access(lockfile.parent, os.W_OK):
+        # SHARED store of the system installation
+        return
+    for path in (lockfile, lockfile.with_suffix('.json')):
+        if path.exists():
+            path.unlink()
+
+
+def lock_entries(home):
+    """Returns a list of (lockfile, metadata dict) in the store"""
+    entries = []
+    ldir = lock_dir(home)
+    if not ldir.exists():
+        return entries
+    for lockfile in sorted(ldir.glob('*.txt')):
+        metafile = lockfile.with_suffix('.json')
+        try:
+            meta = json.loads(metafile.read_text())
+        except (OSError, ValueError):
+            meta = {'name': '?', 'created': lockfile.stat().st_mtime}
+        entries.append((lockfile, meta))
+    return entries
+
+
+def lock_list(home):
+    """Prints the lockfile store"""
+    entries = lock_entries(home)
+    print(f'[INFO] {len(entries)} lockfiles in {lock_dir(home)}')
+    for lockfile, meta in entries:
+        days = (time.time() - meta.get('created', 0)) / 86400
+        print(f"    {lockfile.stem[:12]}  {days:6.1f} days  {meta['name']}")
+
+
+def lock_evict_stale(home, max_age=30):
+    """Removes the lockfiles older than max_age days (0 removes all)"""
+    removed = 0
+    for lockfile, meta in lock_entries(home):
+        days = (time.time() - meta.get('created', 0)) / 86400
+        if days >= max_age:
+            lock_evict(lockfile)
+            removed += 1
+    print(f'[INFO] {removed} lockfiles evicted')
+
+
+def env_name(pkg):
+    """Returns the environment name for a package line of the env file.
+    Pinned packages add the version without dots, i.e. hicexplorer=3.2
+    is installed in the hicexplorer32-env environment.
+    """
+    if '=' in pkg:
+        pkname, version = pkg.split('=')
+        version = version.replace('.', '')
+        return pkname + version + '-env'
+    return pkg + '-env'
+
+
+DEFAULT_CHANNELS = ['bioconda', 'conda-forge']
+
+
+def env_spec(line, channels=None):
+    """Returns the specification of the environment for a line of the env
+    file: a dict with the env name, packages and channels.
+
+    The first package names the env (see env_name). A line can have more
+    packages, extra channels (-c channel, searched before the default
+    ones) and the env name (-n name):
+
+        hicexplorer=3.2 hic2cool
+        snakePipes -c mpi-ie -n snakePipes
+
+    A -c or -n without value or a line without packages raises
+    ValueError.
+    """
+    channels = list(channels or DEFAULT_CHANNELS)
+    packages, extra, name = [], [], None
+    tokens = iter(line.split())
+    for token in tokens:
+        if token in ('-c', '-n'):
+            value = next(tokens, None)
+            if value is None or value.startswith('-'):
+                raise ValueError(f'{token} without a value')
+            if token == '-c':
+                extra.append(value)
             else:
-                cmd = base_cmd.format(envname, pkg)
-            check_output(cmd.split(), preexec_fn=demote(uid, uid), env=myenv,
-                         stderr=PIPE, timeout=600)
-            # CONDITIONALs END
-            # ###
+                name = value
         else:
-            print(f'[NOT INSTALLING] {envname}:, already installed!')
+            packages.append(token)
+    if not packages:
+        raise ValueError('no packages')
+    return {'name': name or env_name(packages[0]),
+            'packages': packages,
+            'channels': extra + [ch for ch in channels if ch not in extra]}
 
 
-def read_env_file(fname):
-    """Returns a lsit with the packages to install as conda environments
+def read_env_specs(fname):
+    """Returns the env specs (see env_spec) of a text env file (see
+    read_env_file) or of a YAML env file (.yml, .yaml):
+
+        channels: [bioconda, conda-forge]   # default channels
+        envs:
+          - fastqc                          # one package, default channels
+          - packages: [hicexplorer=3.2, hic2cool]
+          - name: snakePipes
+            packages: [snakePipes]
+            channels: [mpi-ie, bioconda, conda-forge]
+            lockfile: locks/snakePipes.txt  # explicit lockfile, no solving
+          - packages: [gromacs]
+            commands: [gmx]                 # lazy shims (see --lazy)
+
+    Lockfile paths are relative to the YAML file. The invalid entries are
+    reported (file:line, file:envs[index] for YAML) all at once and the
+    program exits.
+    """
+    fname = Path(fname)
+    errors = []
+    if fname.suffix not in ('.yml', '.yaml'):
+        specs = []
+        for lineno, line in read_env_file(fname, numbered=True):
+            try:
+                specs.append(env_spec(line))
+            except ValueError as err:
+                errors.append(f'{fname}:{lineno}: {err}: {line}')
+        exit_on_errors(errors)
+        return specs
+    if yaml is None:
+        print(f'[ERROR] PyYAML is needed to read {fname}')
+        sys.exit(1)
+    with open(fname) as inf:
+        data = yaml.safe_load(inf) or {}
+    channels = data.get('channels', DEFAULT_CHANNELS)
+    specs = []
+    for index, entry in enumerate(data.get('envs', [])):
+        if isinstance(entry, str):
+            try:
+                specs.append(env_spec(entry, channels=channels))
+            except ValueError as err:
+                errors.append(f'{fname}:envs[{index}]: {err}: {entry}')
+            continue
+        packages = [str(pkg) for pkg in entry.get('packages') or []]
+        if not packages:
+            errors.append(f'{fname}:envs[{index}]: no packages')
+            continue
+        spec = {'name': entry.get('name') or env_name(packages[0]),
+                'packages': packages,
+                'channels': list(entry.get('channels', channels))}
+        if entry.get('lockfile'):
+            spec['lockfile'] = str(fname.parent.absolute()/entry['lockfile'])
+        if entry.get('commands'):
+            spec['commands'] = [str(cmd) for cmd in entry['commands']]
+        specs.append(spec)
+    exit_on_errors(errors)
+    return specs
+
+
+def exit_on_errors(errors):
+    """Prints the env file errors and exits if there are any"""
+    for error in errors:
+        print(f'[ERROR] {error}')
+    if errors:
+        sys.exit(1)
+
+
+def repodata_dir(home):
+    """Directory of the repodata index and downloads, the same before and
+    after the user stage creates the distribution home: /var/cache/seisbio
+    for root (system wide installation), the home for local users."""
+    if os.getuid() == 0:
+        return Path('/var/cache/seisbio')
+    return Path(f'{HOME_ROOT}/{home}')/'.seisbio'
+
+
+def repodata_index(channels, home='seisbio', channel_alias=None,
+                   offline=False, refresh=False):
+    """Builds or refreshes the SQLite index of the channels repodata
+    (platform and noarch subdirs) and returns the open connection.
+
+    The repodata.json.bz2 files (repodata.json if the mirror does not have
+    them) go through fetch_url, so a refresh is a conditional request per
+    channel and a subdir is only indexed again when its checksum changed.
+    Big channels change often (conda-forge every hour) and indexing them
+    takes minutes and GBs of memory, so only the subdirs not indexed yet
+    are downloaded unless refresh.
+
+    Keyword Arguments:
+    channel_alias -- str (default https://conda.anaconda.org)
+                     Base URL of the channels, file:// for a local mirror.
+    offline       -- bool (default False)
+                     Use the index as it is, nothing is downloaded.
+    refresh       -- bool (default False)
+                     Refresh the subdirs already indexed too.
+    """
+    channel_alias = (channel_alias or CHANNEL_ALIAS).rstrip('/')
+    path = repodata_dir(home)/'repodata.sqlite'
+    path.parent.mkdir(parents=True, exist_ok=True)
+    db = sqlite3.connect(path, check_same_thread=False)
+    db.execute('CREATE TABLE IF NOT EXISTS sources '
+               '(channel TEXT, subdir TEXT, sha256 TEXT, updated REAL, '
+               'PRIMARY KEY (channel, subdir))')
+    db.execute('CREATE TABLE IF NOT EXISTS packages '
+               '(channel TEXT, subdir TEXT, name TEXT, version TEXT)')
+    db.execute('CREATE INDEX IF NOT EXISTS packages_name '
+               'ON packages (name, channel)')
+    if offline:
+        return db
+    cache_dir = repodata_dir(home)/'downloads'
+    for channel in channels:
+        for subdir in (conda_platform(), 'noarch'):
+            if not refresh and db.execute(
+                    'SELECT 1 FROM sources WHERE channel=? AND subdir=?',
+                    (channel, subdir)).fetchone():
+                continue
+            url = f'{channel_alias}/{channel}/{subdir}/repodata.json'
+            cached = None
+            # one try of the .bz2, mirrors may only have repodata.json
+            for url, retries in ((url + '.bz2', 1), (url, 3)):
+                try:
+                    with profile_step(f'repodata:{channel}/{subdir}') \
+                            as record:
+                        cached = fetch_url(url, cache_dir, retries=retries)
+                        record['bytes'] = FETCH_BYTES[url]
+                    break
+                except DownloadError as err:
+                    error = err
+            if cached is None:
+                print(f'[WARN] {error}, using the indexed repodata')
+                continue
+            digest = json.loads(Path(str(cached) + '.json').read_text())
+            row = db.execute('SELECT sha256 FROM sources WHERE channel=? '
+                             'AND subdir=?', (channel, subdir)).fetchone()
+            if row and row[0] == digest['sha256']:
+                continue
+            print(f'[INFO] Indexing {channel}/{subdir} repodata')
+            opener = bz2.open if url.endswith('.bz2') else open
+            with opener(cached, 'rt') as inf:
+                repodata = json.load(inf)
+            rows = set()
+            for key in ('packages', 'packages.conda'):
+                for record in repodata.get(key, {}).values():
+                    rows.add((channel, subdir, record['name'],
+                              record['version']))
+            del repodata
+            with db:
+                db.execute('DELETE FROM packages WHERE channel=? AND '
+                           'subdir=?', (channel, subdir))
+                db.executemany('INSERT INTO packages VALUES (?, ?, ?, ?)',
+                               rows)
+                db.execute('INSERT OR REPLACE INTO sources VALUES '
+                           '(?, ?, ?, ?)',
+                           (channel, subdir, digest['sha256'], time.time()))
+    return db
+
+
+def version_matches(version, pin):
+    """conda '=' semantics, 3.2 matches 3.2 and 3.2.*"""
+    return version == pin or version.startswith(pin + '.')
+
+
+def version_key(version):
+    """Sort key of conda versions: numbers compare as numbers and letters
+    (dev, a, rc...) before the end of the version, 1.0rc1 < 1.0 < 1.0.1"""
+    key = []
+    for part in re.findall(r'\d+|[a-zA-Z]+', version.split('+')[0]):
+        if part.isdigit():
+            key.append((2, int(part)))
+        elif part.lower() == 'post':
+            key.append((3, part))
+        else:
+            key.append((0, part.lower()))
+    return key + [(1, '')]
+
+
+def plan_updates(specs, listings, db):
+    """Newer versions of the packages of each env in the repodata index
+    that satisfy their pins. Only the packages of the spec are compared,
+    their dependencies follow them.
 
     Parameters
     ----------
-    fname : filename, str
-
+    specs : list of env specs (see env_spec)
+    listings : dict, env name -> {package name: installed version}
 
     Returns
     -------
-    out :
-
+    out : dict, env name -> list of (name, installed, newer) tuples. The
+          envs without newer versions are not included.
     """
-    pkg_list = []
-    with open(fname) as inf:
-        for line in inf:
-            line = line.strip()
-            if line == '':
+    updates = {}
+    for spec in specs:
+        installed = listings.get(spec['name'])
+        if not installed:
+            continue
+        channels = spec['channels']
+        marks = ','.join('?' * len(channels))
+        for pkg in spec['packages']:
+            name, pin = parse_pin(pkg)
+            if name not in installed:
                 continue
-            elif line[0] == '#':
+            versions = [row[0] for row in db.execute(
+                f'SELECT DISTINCT version FROM packages WHERE name=? AND '
+                f'channel IN ({marks})', [name] + channels)
+                if not pin or version_matches(row[0], pin)]
+            if not versions:
                 continue
-            elements = line.split()
-            if len(elements) == 1:
-                # only one package per line --
-                # assume existence ib bioconda or conda-foge?
-                pkg_list.append(elements[0])
-            else:
-                # TODO
-                # Here put what to do if you want a special environmet
-                pass
-    return pkg_list
+            newest = max(versions, key=version_key)
+            if version_key(newest) > version_key(installed[name]):
+                updates.setdefault(spec['name'], []).append(
+                    (name, installed[name], newest))
+    return updates
 
 
-def update_bashrc(home, distribution):
-    """Update the /etc/bash.bashrc and backup the original one
+def preflight(specs, db, source=''):
+    """Checks every package (and pin) of the env specs against the
+    repodata index. All the errors are returned at once.
 
-    Keyword Arguments:
-    home         --
-    distribution --
-    bashrc       -- str, filepath
-                    Bash rc file to modify
+    Returns
+    -------
+    out : list of error messages, empty if everything is ok
     """
-    # backup bashrcn
-    check_output(['cp', '/etc/bash.bashrc', '/etc/bash.bashrc.backup'])
-    with open('/etc/bash.bashrc.backup', 'a') as backuprc:
-        msg = ("\n\n# --- Backup of /bash.bashrc created\n"
-               "# --- by SEISbio installation\n")
-        backuprc.write(msg)
+    errors = []
+    names = None
+    for spec in specs:
+        channels = [ch for ch in spec['channels']]
+        marks = ','.join('?' * len(channels))
+        for pkg in spec['packages']:
+            name, pin = parse_pin(pkg)
+            versions = [row[0] for row in db.execute(
+                f'SELECT DISTINCT version FROM packages WHERE name=? AND '
+                f'channel IN ({marks})', [name] + channels)]
+            where = f"{source}: {spec['name']}"
+            if not versions:
+                if names is None:
+                    names = [row[0] for row in db.execute(
+                        'SELECT DISTINCT name FROM packages')]
+                close = difflib.get_close_matches(name, names, n=3)
+                hint = f" (did you mean {', '.join(close)}?)" if close else ''
+                errors.append(f"{where}: {name} not found in "
+                              f"{', '.join(channels)}{hint}")
+            elif pin and not any(version_matches(v, pin) for v in versions):
+                errors.append(f'{where}: no {name} version matches {pin}')
+    return errors
 
-    # Get conda bashrc stringt RE
-    conda_re = re.compile('(# >>> conda initialize >>>.*'
-                          '# <<< conda initialize <<<)',
-                          re.DOTALL)
-    with open(f'/home/{home}/.bashrc') as inf:
-        text = inf.read()
-    try:
-        conda_text = conda_re.findall(text)[0]
-    except IndexError:
-        print(f'[WARN] Something is wrong with /home/{home}/.bashrc file!')
-        print('[EXIT!]')
-        exit()
-    # Update /etc/bash.bashrc
-    with open('/etc/bash.bashrc', 'a') as bashrc:
-        bashrc.write('\n\n# --- Added by SEISbio\n' + conda_text)
 
+def run_preflight(envfile, home='seisbio', channel_alias=None, offline=False,
+                  refresh=False):
+    """Validates the env file before any installation step.
 
-def main():
-    # TODO (acph) ask if superuser
-    args = arguments()
-    if args.distribution == 'miniforge':
-        manager = 'mamba'
-    elif args.distribution == 'miniconda':
-        manager = 'conda'
+    Returns
+    -------
+    out : bool, True if there are no errors
+    """
+    start = time.time()
+    specs = read_env_specs(envfile)
+    channels = sorted({ch for spec in specs for ch in spec['channels']})
+    db = repodata_index(channels, home=home, channel_alias=channel_alias,
+                        offline=offline, refresh=refresh)
+    if not db.execute('SELECT 1 FROM sources LIMIT 1').fetchone():
+        print('[WARN] Empty repodata index, the env file is not checked')
+        return True
+    errors = preflight(specs, db, source=Path(envfile).name)
+    db.close()
+    for error in errors:
+        print(f'[ERROR] {error}')
+    print(f'[PREFLIGHT] {len(specs)} envs checked, {len(errors)} errors '
+          f'({time.time() - start:.2f}s)')
+    return not errors
+
+
+def create_env(envname, cmd, logfile, env=None, uid=1015, timeout=600,
+               append=False, cwd=None):
+    """Runs one environment command (create, install or remove) writing
+    its output to logfile.
+
+    Returns
+    -------
+    out : dict, with the env name, status ('ok', 'failed' or 'timeout'),
+          wall time in seconds and log file path
+    """
+    start = time.time()
+    try:
+        run_logged(cmd, logfile, step=envname, env=env, uid=uid,
+                   timeout=timeout, append=append, cwd=cwd)
+        status = 'ok'
+    except CalledProcessError:
+        status = 'failed'
+    except TimeoutExpired:
+        status = 'timeout'
+    return {'env': envname, 'status': status,
+            'seconds': time.time() - start, 'log': str(logfile)}
+
+
+def print_envs_summary(results):
+    """Prints the combined summary of install_virtual_envs results"""
+    print('[SUMMARY] Virtual environments')
+    for res in sorted(results, key=lambda r: r['seconds'], reverse=True):
+        print(f"    {res['status']:8} {res['seconds']:8.1f}s  "
+              f"{res.get('action', 'create'):6}  "
+              f"lock {res.get('lock', '-'):4}  {res['env']}")
+        if res['status'] != 'ok':
+            print(f"             log: {res['log']}")
+    failed = [r for r in results if r['status'] != 'ok']
+    print(f'[SUMMARY] {len(results) - len(failed)} done, '
+          f'{len(failed)} failed')
+
+
+def env_index(distribution='miniforge', home='seisbio', uid=1015, env=None):
+    """Returns the index of the existing environments of the distribution.
+
+    The env list comes from `conda env list --json` and the installed
+    packages of each env are read from its conda-meta directory, no extra
+    subprocess per environment.
+
+    Returns
+    -------
+    out : dict, env name -> {'name', 'prefix', 'packages'}
+          packages is a dict, package name -> (version, build)
+    """
+    conda_path = f'{HOME_ROOT}/{home}/{distribution}/bin/conda'
+    out = check_output([conda_path, 'env', 'list', '--json'],
+                       **as_user(uid), env=env, stderr=PIPE)
+    base_prefix = f'{HOME_ROOT}/{home}/{distribution}'
+    index = {}
+    for prefix in json.loads(out.decode())['envs']:
+        name = 'base' if prefix == base_prefix else Path(prefix).name
+        index[name] = {'name': name, 'prefix': prefix,
+                       'packages': installed_packages(prefix)}
+    return index
+
+
+def installed_packages(prefix):
+    """Returns the installed packages of prefix reading the
+    conda-meta/<name>-<version>-<build>.json file names.
+
+    Returns
+    -------
+    out : dict, package name (lowercase, see parse_pin) -> (version, build)
+    """
+    packages = {}
+    meta_dir = Path(prefix)/'conda-meta'
+    if not meta_dir.is_dir():
+        return packages
+    for meta in meta_dir.glob('*.json'):
+        parts = meta.stem.rsplit('-', 2)
+        if len(parts) == 3:
+            packages[parts[0].lower()] = (parts[1], parts[2])
+    return packages
+
+
+def parse_pin(pkg):
+    """Package name and pinned version of the package line pkg (name,
+    name=version or name==version). Names are lowercase, like conda
+    MatchSpec and the repodata, snakePipes is snakepipes.
+
+    Returns
+    -------
+    out : tuple, (name, version), version is '' without pin
+    """
+    name, _, version = pkg.partition('=')
+    return name.lower(), version.lstrip('=')
+
+
+def pin_satisfied(pkg, packages):
+    """True if the package line pkg (name or name=version) is installed in
+    packages (see installed_packages). Like conda, name=3.2 matches the
+    3.2 and 3.2.* versions."""
+    name, version = parse_pin(pkg)
+    if name not in packages:
+        return False
+    if not version:
+        return True
+    return version_matches(packages[name][0], version)
+
+
+def plan_envs(specs, index, prune=False):
+    """Desired vs actual environments diff.
+
+    Keyword Arguments:
+    specs -- list of env specs (see env_spec)
+    index -- dict, see env_index
+    prune -- bool (default False)
+             Remove the SEISbio environments (*-env) that are not in specs.
+
+    Returns
+    -------
+    out : dict with the 'create', 'update' and 'ok' spec lists and the
+          'remove' env names list
+    """
+    plan = {'create': [], 'update': [], 'ok': [], 'remove': []}
+    seen = set()
+    for spec in specs:
+        if spec['name'] in seen:
+            continue
+        seen.add(spec['name'])
+        if spec['name'] not in index:
+            plan['create'].append(spec)
+            continue
+        packages = index[spec['name']]['packages']
+        if all(pin_satisfied(pkg, packages) for pkg in spec['packages']):
+            plan['ok'].append(spec)
+        else:
+            plan['update'].append(spec)
+    if prune:
+        plan['remove'] = sorted(name for name in index
+                                if name.endswith('-env') and name not in seen)
+    return plan
+
+
+def env_lockfile(home, spec, refresh_locks=False):
+    """Lockfile to create the env without solving: the spec lockfile or
+    the one in the lockfile store. None if the env must be solved."""
+    if spec.get('lockfile'):
+        return Path(spec['lockfile'])
+    if refresh_locks:
+        return None
+    return lock_lookup(home, spec)
+
+
+def manager_jobs(manager, jobs):
+    """Env commands of manager that can run at the same time. libmamba
+    locks each package of the shared cache while it is extracted, conda
+    only with its experimental lock feature, so conda runs one at a time.
+    """
+    if manager == 'conda' and jobs > 1:
+        print(f'[WARN] conda does not lock its package cache, {jobs} jobs '
+              'reduced to 1')
+        return 1
+    return jobs
+
+
+def channel_batches(specs, solves):
+    """Groups the specs by channel list.
+
+    Keyword Arguments:
+    solves -- function, True if a spec needs a solve (no lockfile)
+
+    Returns
+    -------
+    out : tuple of lists of specs, the first spec that needs a solve of
+          each channel list and the rest of specs
+    """
+    first, rest, seen = [], [], set()
+    for spec in sorted(specs, key=lambda sp: sp['channels']):
+        channels = tuple(spec['channels'])
+        if channels not in seen and solves(spec):
+            seen.add(channels)
+            first.append(spec)
+        else:
+            rest.append(spec)
+    return first, rest
+
+
+def explicit_urls(lockfile):
+    """Package records (url, md5, sha256) of an explicit lockfile, lines
+    <url>#<md5> or <url>#sha256:<hex>"""
+    records = []
+    for line in Path(lockfile).read_text().splitlines():
+        line = line.strip()
+        if not line or line.startswith(('#', '@')):
+            continue
+        url, _, digest = line.partition('#')
+        record = {'url': url, 'md5': None, 'sha256': None}
+        if digest.startswith('sha256:'):
+            record['sha256'] = digest[7:]
+        elif digest:
+            record['md5'] = digest
+        records.append(record)
+    return records
+
+
+def fetch_actions(cmd, env=None, uid=1015, timeout=600):
+    """Package records (url, md5, sha256) that a manager command run with
+    --dry-run --json would download, its FETCH actions"""
+    try:
+        out = check_output(cmd + ['--dry-run', '--json'], env=env,
+                           **as_user(uid), stderr=DEVNULL,
+                           timeout=timeout)
+    except (CalledProcessError, TimeoutExpired) as err:
+        # the env creation will show the error
+        out = getattr(err, 'output', None) or b'{}'
+    try:
+        actions = json.loads(out).get('actions', {})
+    except ValueError:
+        return []
+    if isinstance(actions, list):
+        actions = actions[0] if actions else {}
+    return [{'url': rec['url'], 'md5': rec.get('md5'),
+             'sha256': rec.get('sha256')}
+            for rec in actions.get('FETCH', []) if rec.get('url')]
+
+
+def download_package(record, pkgs_dir, home='seisbio', uid=1015,
+                     retries=3):
+    """Downloads a package tarball into the package cache verifying its
+    sha256 (or md5). The tarball is locked while it is downloaded, a
+    tarball fetched by another process is not downloaded again.
+
+    Returns
+    -------
+    out : int, downloaded bytes
+    """
+    url = record['url']
+    fname = url.split('/')[-1]
+    dest = Path(pkgs_dir)/fname
+    with file_lock(locks_dir(home)/'pkgs'/f'{fname}.lock', label=fname):
+        if dest.exists():
+            return 0
+        tmp = dest.with_name(fname + '.part')
+        for attempt in range(1, retries + 1):
+            digest = hashlib.sha256() if record['sha256'] else hashlib.md5()
+            expected = record['sha256'] or record['md5']
+            try:
+                size = 0
+                with urlopen(url, timeout=60) as response, \
+                        open(tmp, 'wb') as out:
+                    for block in iter(lambda: response.read(1 << 20), b''):
+                        out.write(block)
+                        digest.update(block)
+                        size += len(block)
+                if expected and digest.hexdigest() != expected.lower():
+                    raise DownloadError(f'{fname} checksum mismatch')
+                chown_user(tmp, uid)
+                os.replace(tmp, dest)
+                return size
+            except (OSError, ValueError, DownloadError) as err:
+                print(f'[WARN] Download of {fname} failed ({err}), '
+                      f'attempt {attempt}')
+                tmp.unlink(missing_ok=True)
+                if attempt < retries:
+                    time.sleep(2 ** attempt)
+    raise DownloadError(f'Could not download {url} after {retries} attempts')
+
+
+def prefetch_packages(specs, manager='mamba', distribution='miniforge',
+                      home='seisbio', uid=1015, jobs=1, workers=8,
+                      refresh_locks=False, base=False, timeout=600):
+    """Downloads the packages of all the envs to create or update before
+    any of them is created, each distinct tarball once.
+
+    The package URLs come from the env lockfiles (see env_lockfile) or
+    from a dry-run solve of the envs without one (jobs at the same time).
+    The URLs of all the envs are deduplicated, the packages already in the
+    package caches are skipped and the rest is downloaded by a pool of
+    workers (see download_package) into the distribution pkgs directory.
+    The manager then only extracts and links them.
+
+    Keyword Arguments:
+    base -- bool (default False)
+            Also the BASE_PKGS of install_distribution_base.
+
+    Returns
+    -------
+    out : list of the URLs that could not be downloaded, the manager
+          downloads them when the env is created
+    """
+    prefix = f'{HOME_ROOT}/{home}/{distribution}'
+    manager_path = f'{prefix}/bin/{manager}'
+    pkgs_dir = Path(prefix)/'pkgs'
+    myenv = os.environ.copy()
+    myenv['HOME'] = f'{HOME_ROOT}/{home}/'
+    pkgs_env(myenv, pkgs_dir)
+    index = env_index(distribution=distribution, home=home, uid=uid,
+                      env=myenv)
+    plan = plan_envs(specs, index)
+    todo = [('create', spec) for spec in plan['create']]
+    todo += [('install', spec) for spec in plan['update']]
+    if base:
+        todo.append(('base', base_spec(distribution=distribution,
+                                       home=home, uid=uid, env=myenv)))
+    start = time.time()
+
+    def records(item):
+        action, spec = item
+        lockfile = env_lockfile(home, spec, refresh_locks)
+        if lockfile is not None:
+            return explicit_urls(lockfile)
+        if action == 'base':
+            cmd = [manager_path, 'install', '-p', prefix]
+        else:
+            cmd = [manager_path, action, '-n', spec['name']]
+        for channel in spec['channels']:
+            cmd += ['-c', channel]
+        return fetch_actions(cmd + spec['packages'], env=myenv, uid=uid,
+                             timeout=timeout)
+
+    with profile_step('prefetch:plan', envs=len(todo)):
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            found = [rec for recs in pool.map(records, todo) for rec in recs]
+    unique = {}
+    for rec in found:
+        unique.setdefault(rec['url'].split('/')[-1], rec)
+    caches = [pkgs_dir] + [Path(d) for d in SHARED['pkgs']]
+    missing = [rec for fname, rec in unique.items()
+               if not any((cache/fname).exists() or
+                          (cache/re.sub(r'(\.tar\.bz2|\.conda)$', '',
+                                        fname)).is_dir()
+                          for cache in caches)]
+    print(f'[PREFETCH] {len(found)} packages in {len(todo)} envs, '
+          f'{len(unique)} distinct, {len(missing)} to download')
+    failed = []
+
+    def fetch(rec):
+        try:
+            return download_package(rec, pkgs_dir, home=home, uid=uid)
+        except DownloadError as err:
+            print(f'[WARN] {err}')
+            failed.append(rec['url'])
+            return 0
+
+    with profile_step('prefetch:download', packages=len(missing)) as record:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            record['bytes'] = sum(pool.map(fetch, missing))
+    # the manager maps the tarballs to their channel with urls.txt
+    done = [rec['url'] for rec in missing if rec['url'] not in failed]
+    if done:
+        with file_lock(locks_dir(home)/'urls.txt.lock'):
+            with open(pkgs_dir/'urls.txt', 'a') as out:
+                out.write(''.join(f'{url}\n' for url in done))
+    print(f"[PREFETCH] {record['bytes'] / 1e6:.1f} MB downloaded, "
+          f'{len(failed)} failed ({time.time() - start:.1f}s)')
+    return failed
+
+
+def lockfile_lines(lockfile):
+    """Package lines (<url>#<checksum>) of an explicit lockfile, in order"""
+    return [line.strip() for line in Path(lockfile).read_text().splitlines()
+            if line.strip() and not line.startswith(('#', '@'))]
+
+
+def template_cores(closures, min_core=10, max_templates=8):
+    """Groups the envs that share a package core, greedily from the
+    biggest env: an env joins the template whose core keeps the most of
+    its packages, at least min_core and half of the core. The core of a
+    template is the intersection of its envs closures.
+
+    Parameters
+    ----------
+    closures : dict, env name -> set of package lines (see lockfile_lines)
+
+    Returns
+    -------
+    out : list of (core, env names) tuples, templates of two or more envs
+    """
+    clusters = []
+    for name in sorted(closures, key=lambda n: (-len(closures[n]), n)):
+        packages = closures[name]
+        best, best_core = None, set()
+        for cluster in clusters:
+            core = cluster['core'] & packages
+            if len(core) > len(best_core):
+                best, best_core = cluster, core
+        if (best is not None and len(best_core) >= min_core and
+                2 * len(best_core) >= len(best['core'])):
+            best['core'] = best_core
+            best['envs'].append(name)
+        elif len(clusters) < max_templates:
+            clusters.append({'core': set(packages), 'envs': [name]})
+    return [(cluster['core'], cluster['envs']) for cluster in clusters
+            if len(cluster['envs']) > 1]
+
+
+def clone_prefix(template, prefix, files):
+    """Copies the template prefix in prefix hardlinking its files. The
+    conda-meta records and the files with the template prefix in them
+    (see prefix_files) are copied, the last ones relocated to prefix.
+
+    Returns
+    -------
+    out : tuple, (hardlinked files, copied files)
+    """
+    template, prefix = Path(template), Path(prefix)
+    linked = copied = 0
+    for root, dirs, fnames in os.walk(template):
+        rel_root = Path(root).relative_to(template)
+        dest_root = prefix/rel_root
+        dest_root.mkdir(parents=True, exist_ok=True)
+        for name in dirs + fnames:
+            src = Path(root)/name
+            if src.is_symlink():
+                os.symlink(os.readlink(src), dest_root/name)
+                continue
+            if name in dirs:
+                continue
+            rel = str(rel_root/name) if str(rel_root) != '.' else name
+            # conda appends to conda-meta/history, never share it
+            if rel in files or rel_root.parts[:1] == ('conda-meta',):
+                shutil.copy2(src, dest_root/name)
+                copied += 1
+            else:
+                os.link(src, dest_root/name)
+                linked += 1
+    relocate(prefix, files, template, prefix)
+    return linked, copied
+
+
+def build_templates(specs, manager='mamba', distribution='miniforge',
+                    home='seisbio', uid=1015, jobs=1, refresh_locks=False,
+                    timeout=600, env=None):
+    """Creates the template envs of the specs with a lockfile (see
+    template_cores), jobs at the same time, from explicit core files.
+
+    Returns
+    -------
+    out : dict, env name -> (template prefix, prefix files of the
+          template, explicit file of the extra packages or None)
+    """
+    prefix = f'{HOME_ROOT}/{home}/{distribution}'
+    tdir = Path(f'{HOME_ROOT}/{home}')/'.seisbio'/'templates'
+    tdir.mkdir(parents=True, exist_ok=True)
+    lines = {}
+    for spec in specs:
+        lockfile = env_lockfile(home, spec, refresh_locks)
+        if lockfile is not None and lockfile.exists():
+            lines[spec['name']] = lockfile_lines(lockfile)
+    cores = template_cores({name: set(pkgs) for name, pkgs in lines.items()})
+
+    def build(item):
+        core, envnames = item
+        # explicit files keep the lockfile order
+        core_lines = [line for line in lines[envnames[0]] if line in core]
+        key = hashlib.sha256('\n'.join(core_lines).encode()).hexdigest()
+        # long name, the binary files can be relocated to shorter prefixes
+        template = f'{prefix}/envs/seis-template-{key}'
+        core_file = tdir/f'{key}.txt'
+        core_file.write_text('@EXPLICIT\n' + '\n'.join(core_lines) + '\n')
+        if not Path(f'{template}/conda-meta').is_dir():
+            cmd = [f'{prefix}/bin/{manager}', 'create', '-p', template,
+                   '--file', str(core_file), '-y', '-q']
+            with cache_lock(home, distribution, manager=manager), \
+                    profile_step(f'template:{key[:12]}',
+                                 packages=len(core_lines)):
+                res = create_env(f'seis-template-{key[:12]}', cmd,
+                                 log_dir(home)/f'template-{key[:12]}.log',
+                                 env=env, uid=uid, timeout=timeout)
+            if res['status'] != 'ok':
+                print(f'[WARN] Template {key[:12]} failed, its envs are '
+                      'created from scratch')
+                shutil.rmtree(template, ignore_errors=True)
+                return {}
+        files = prefix_files(template)
+        layers = {}
+        for envname in envnames:
+            # the binary files only take shorter prefixes
+            if (len(f'{prefix}/envs/{envname}') > len(template) and
+                    'binary' in files.values()):
+                continue
+            extras = [line for line in lines[envname] if line not in core]
+            extras_file = None
+            if extras:
+                extras_file = tdir/f'{envname}-extras.txt'
+                extras_file.write_text('@EXPLICIT\n' + '\n'.join(extras) +
+                                       '\n')
+            layers[envname] = (template, files, extras_file)
+        print(f'[TEMPLATE] {len(core_lines)} packages shared by '
+              f"{len(layers)} envs: {', '.join(layers)}")
+        return layers
+
+    layers = {}
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        for built in pool.map(build, cores):
+            layers.update(built)
+    return layers
+
+
+def install_virtual_envs(pkg_list, manager='mamba',
+                         distribution='miniforge',
+                         home='seisbio', uid=1015, jobs=1,
+                         refresh_locks=False, prune=False, timeout=600,
+                         journal=None, templates=False):
+    """Installing virtual environments for many bioinformatics programs from:
+    - conda-forge
+    - bioconda
+    - Other repositories
+
+    Only the differences between the env file and the existing envs are
+    applied: missing envs are created, envs without the requested packages
+    or pins are updated and, with prune, the unlisted envs are removed.
+
+    Keyword Arguments:
+    jobs -- int (default 1)
+            Number of environments created at the same time. All the
+            workers share the distribution package cache, mamba (libmamba)
+            locks each package while it is downloaded and extracted.
+            conda does not, with conda the envs are installed one at a
+            time (see manager_jobs).
+    refresh_locks -- bool (default False)
+            Solve every environment again ignoring the lockfile store.
+            Environments created by solving always update the store.
+            Each env action holds the env lock and, shared, the package
+            cache lock (see file_lock), other installers running at the
+            same time wait for the env and reuse it.
+    prune -- bool (default False)
+            Remove the *-env environments that are not in pkg_list.
+    timeout -- int (default 600)
+            Seconds for each environment command.
+    journal -- dict (default None)
+            Provisioning journal (see journal_load). Each finished env is
+            recorded with its spec hash and the envs recorded with the same
+            hash are skipped.
+    templates -- bool (default False)
+            The envs to create from a lockfile that share a package core
+            are hardlinked clones (see clone_prefix) of a template env of
+            the core plus their extra packages (see build_templates). The
+            templates are removed at the end.
+
+    Returns
+    -------
+    out : list of dicts, see create_env. Only the failed environments.
+    """
+    jobs = manager_jobs(manager, jobs)
+    # paths
+    manager_path = f'{HOME_ROOT}/{home}/{distribution}/bin/{manager}'
+    envs_path = f'{HOME_ROOT}/{home}/{distribution}/envs'
+    home_path = f'{HOME_ROOT}/{home}/'
+    # basic config
+    myenv = os.environ.copy()
+    myenv['HOME'] = home_path
+    # same cache for every worker, whatever the user config says
+    pkgs_dir = f'{HOME_ROOT}/{home}/{distribution}/pkgs'
+    pkgs_env(myenv, pkgs_dir)
+    index = env_index(distribution=distribution, home=home, uid=uid,
+                      env=myenv)
+    specs = [pkg if isinstance(pkg, dict) else env_spec(pkg)
+             for pkg in pkg_list]
+    # the journaled envs are still listed, prune must not remove them
+    plan = plan_envs(specs, index, prune=prune)
+    if journal is not None:
+        done = {spec['name'] for spec in specs
+                if journal['envs'].get(spec['name']) == lock_key(spec)}
+        for name in sorted(done):
+            print(f"[RESUME] {name} already done.")
+        for action in ('create', 'update', 'ok'):
+            plan[action] = [spec for spec in plan[action]
+                            if spec['name'] not in done]
+    for spec in plan['ok']:
+        print(f"[NOT INSTALLING] {spec['name']}:, already installed!")
+    print(f"[INFO] {len(plan['create'])} envs to create, "
+          f"{len(plan['update'])} to update, "
+          f"{len(plan['remove'])} to remove")
+
+    def create(spec):
+        envname = spec['name']
+        logfile = log_dir(home)/f'{envname}.log'
+        print('[INSTALLING]', 'Environmet for', envname, 'package')
+        lockfile = env_lockfile(home, spec, refresh_locks)
+        if lockfile is not None:
+            cmd = [manager_path, 'create', '-n', envname,
+                   '--file', str(lockfile), '-y', '-q']
+            res = create_env(envname, cmd, logfile, env=myenv, uid=uid,
+                             timeout=timeout, cwd=home_path)
+            if res['status'] == 'ok':
+                res['lock'] = 'hit'
+                print(f"[OK] {envname} from lockfile ({res['seconds']:.1f}s)")
+                return res
+            print(f'[WARN] Lockfile of {envname} failed, solving again')
+            if spec.get('lockfile') is None:
+                lock_evict(lockfile)
+            # leftovers of the failed creation
+            run([manager_path, 'env', 'remove', '-n', envname, '-y', '-q'],
+                **as_user(uid), env=myenv, cwd=home_path,
+                stdout=PIPE, stderr=STDOUT)
+        cmd = [manager_path, 'create', '-n', envname]
+        for channel in spec['channels']:
+            cmd += ['-c', channel]
+        cmd += spec['packages'] + ['-y', '-q']
+        res = create_env(envname, cmd, logfile, env=myenv, uid=uid,
+                         append=lockfile is not None, timeout=timeout,
+                         cwd=home_path)
+        res['lock'] = 'miss'
+        if res['status'] == 'ok':
+            lock_store(home, spec, f'{envs_path}/{envname}',
+                       distribution=distribution, env=myenv, uid=uid)
+        print(f"[{res['status'].upper()}] {envname} "
+              f"({res['seconds']:.1f}s)")
+        return res
+
+    def update(spec):
+        envname = spec['name']
+        print('[UPDATING]', 'Environmet', envname)
+        cmd = [manager_path, 'install', '-n', envname]
+        for channel in spec['channels']:
+            cmd += ['-c', channel]
+        cmd += spec['packages'] + ['-y', '-q']
+        res = create_env(envname, cmd, log_dir(home)/f'{envname}.log',
+                         env=myenv, uid=uid, timeout=timeout, cwd=home_path)
+        res['action'] = 'update'
+        if res['status'] == 'ok':
+            lock_store(home, spec, f'{envs_path}/{envname}',
+                       distribution=distribution, env=myenv, uid=uid)
+        print(f"[{res['status'].upper()}] {envname} "
+              f"({res['seconds']:.1f}s)")
+        return res
+
+    def remove(envname):
+        print('[REMOVING]', 'Environmet', envname)
+        cmd = [manager_path, 'env', 'remove', '-n', envname, '-y', '-q']
+        res = create_env(envname, cmd, log_dir(home)/f'{envname}.log',
+                         env=myenv, uid=uid, timeout=timeout, cwd=home_path)
+        res['action'] = 'remove'
+        return res
+
+    layers = {}
+    if templates and plan['create']:
+        layers = build_templates(plan['create'], manager=manager,
+                                 distribution=distribution, home=home,
+                                 uid=uid, jobs=jobs,
+                                 refresh_locks=refresh_locks,
+                                 timeout=timeout, env=myenv)
+    layered = []
+
+    def layer(spec):
+        envname = spec['name']
+        template, files, extras = layers[envname]
+        dest = f'{envs_path}/{envname}'
+        logfile = log_dir(home)/f'{envname}.log'
+        print('[LAYERING]', 'Environmet', envname, 'from template')
+        start = time.time()
+        try:
+            linked, copied = clone_prefix(template, dest, files)
+            chown_tree(dest, uid)
+        except OSError as err:
+            print(f'[WARN] Clone of {envname} failed ({err}), creating it')
+            shutil.rmtree(dest, ignore_errors=True)
+            return create(spec)
+        res = {'env': envname, 'status': 'ok', 'log': str(logfile)}
+        if extras is not None:
+            cmd = [manager_path, 'install', '-n', envname, '--file',
+                   str(extras), '-y', '-q']
+            res = create_env(envname, cmd, logfile, env=myenv, uid=uid,
+                             timeout=timeout, cwd=home_path)
+            if res['status'] != 'ok':
+                print(f'[WARN] Extra packages of {envname} failed, '
+                      'creating it')
+                shutil.rmtree(dest, ignore_errors=True)
+                return create(spec)
+        res.update(seconds=time.time() - start, lock='hit', action='layer')
+        layered.append({'env': envname, 'linked': linked, 'copied': copied,
+                        'extras': (len(lockfile_lines(extras))
+                                   if extras else 0)})
+        print(f"[OK] {envname} from template ({res['seconds']:.1f}s)")
+        return res
+
+    actions = {'create': create, 'update': update, 'remove': remove,
+               'layer': layer}
+
+    def reusable(action, item):
+        # done by another installer while this one waited for the lock
+        if action == 'remove':
+            return not os.path.isdir(f'{envs_path}/{item}')
+        packages = installed_packages(f"{envs_path}/{item['name']}")
+        return bool(packages) and all(pin_satisfied(pkg, packages)
+                                      for pkg in item['packages'])
+
+    def locked(action, item):
+        envname = item if action == 'remove' else item['name']
+        with cache_lock(home, distribution, manager=manager), \
+                env_lock(home, envname) as waited:
+            if waited and reusable(action, item):
+                print(f'[REUSED] {envname}, done by another installer')
+                return {'env': envname, 'status': 'ok', 'seconds': 0.0,
+                        'log': '-', 'action': 'reused'}
+            return actions[action](item)
+
+    def work(action, item):
+        envname = item if action == 'remove' else item['name']
+        before = pkgs_tarballs(pkgs_dir)
+        with profile_step(f'env:{envname}', action=action) as record:
+            res = locked(action, item)
+            record['exit'] = res['status'] if res['status'] != 'ok' else 0
+            record['lock'] = res.get('lock')
+            record['bytes'] = downloaded_bytes(before, pkgs_dir)
+            if action != 'remove':
+                record['disk'] = disk_usage(f'{envs_path}/{envname}')
+        if (journal is not None and action != 'remove' and
+                res['status'] == 'ok'):
+            journal_record(home, journal, 'envs', envname, lock_key(item))
+        return res
+
+    first, rest = channel_batches(
+        [spec for spec in plan['create'] if spec['name'] not in layers],
+        lambda spec: env_lockfile(home, spec, refresh_locks) is None)
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        # one solve per channel set fills the repodata cache of its
+        # channels before the other envs of the set start
+        results = list(pool.map(lambda spec: work('create', spec), first))
+        futures = ([pool.submit(work, 'create', spec) for spec in rest] +
+                   [pool.submit(work, 'layer', spec)
+                    for spec in plan['create'] if spec['name'] in layers] +
+                   [pool.submit(work, action, item)
+                    for action in ('update', 'remove')
+                    for item in plan[action]])
+        results += [future.result() for future in futures]
+    if results:
+        print_envs_summary(results)
+    if layers:
+        print_layers_summary(layers, layered)
+        for template in {template for template, _, _ in layers.values()}:
+            shutil.rmtree(template, ignore_errors=True)
+    return [r for r in results if r['status'] != 'ok']
+
+
+def print_layers_summary(layers, layered):
+    """Prints what the template layering saved compared with creating the
+    same envs independently: packages linked by the manager and files
+    hardlinked from the templates instead of linked package by package"""
+    cores = {}
+    for template, files, _ in layers.values():
+        cores[template] = len(list(Path(template).glob('conda-meta/*.json')))
+    by_env = {envname: cores[template]
+              for envname, (template, _, _) in layers.items()}
+    independent = sum(by_env[rec['env']] + rec['extras'] for rec in layered)
+    linked = sum(cores.values()) + sum(rec['extras'] for rec in layered)
+    saved = 100 * (1 - linked / independent) if independent else 0
+    print(f'[TEMPLATES] {len(cores)} templates for {len(layered)} envs: '
+          f'{linked} packages linked by the manager instead of '
+          f'{independent} ({saved:.0f}% less)')
+    print(f"[TEMPLATES] {sum(rec['linked'] for rec in layered)} files "
+          f"hardlinked from the templates, "
+          f"{sum(rec['copied'] for rec in layered)} copied (conda-meta and "
+          'files with the prefix)')
+
+
+def read_env_file(fname, numbered=False):
+    """Returns a lsit with the packages to install as conda environments
+
+    Parameters
+    ----------
+    fname : filename, str
+    numbered : bool, (line number, line) tuples, for the error messages
+
+
+    Returns
+    -------
+    out : list of str, one per line. Lines with many elements (see
+          env_spec) are returned as they are.
+
+    """
+    pkg_list = []
+    with open(fname) as inf:
+        for lineno, line in enumerate(inf, 1):
+            line = line.strip()
+            if line == '':
+                continue
+            elif line[0] == '#':
+                continue
+            elements = line.split()
+            if len(elements) == 1:
+                # only one package per line --
+                # assume existence ib bioconda or conda-foge?
+                line = elements[0]
+            else:
+                # special environment, see env_spec
+                line = ' '.join(elements)
+            pkg_list.append((lineno, line) if numbered else line)
+    return pkg_list
+
+
+def conda_list(prefix, distribution='miniforge', home='seisbio', uid=1015,
+               env=None):
+    """Installed packages of prefix from `conda list --json`
+
+    Returns
+    -------
+    out : dict, package name -> version. Empty if prefix does not exist.
+    """
+    if not os.path.isdir(prefix):
+        return {}
+    conda_path = f'{HOME_ROOT}/{home}/{distribution}/bin/conda'
+    try:
+        listing = check_output([conda_path, 'list', '--json', '-p', prefix],
+                               **as_user(uid), env=env,
+                               stderr=PIPE)
+    except CalledProcessError:
+        print(f'[WARN] Could not list the packages of {prefix}')
+        return {}
+    return {pkg['name'].lower(): pkg['version'] for pkg in json.loads(listing)}
+
+
+def update_envs(envfile, manager='mamba', distribution='miniforge',
+                home='seisbio', uid=1015, jobs=1, channel_alias=None,
+                offline=False, dry_run=False, timeout=600):
+    """Updates only the envs (and base) with newer versions of their
+    packages in the channels repodata, see plan_updates.
+
+    The installed versions come from conda list --json and the newer
+    ones from the repodata index (see repodata_index). Each env is updated
+    to the planned versions, `install name=version`, so the solve is
+    short and the rest of the env is not touched. The envs are updated
+    at the same time (jobs) and their lockfiles are stored again.
+
+    Keyword Arguments:
+    dry_run -- bool (default False)
+               Only print the plan.
+
+    Returns
+    -------
+    out : list of dicts, see create_env. Only the failed updates.
+    """
+    prefix = f'{HOME_ROOT}/{home}/{distribution}'
+    myenv = os.environ.copy()
+    myenv['HOME'] = f'{HOME_ROOT}/{home}'
+    pkgs_env(myenv, f'{prefix}/pkgs')
+    # same spec as install_distribution_base (lockfile key), plus the
+    # managers themselves
+    base = {'name': 'base', 'packages': BASE_PKGS,
+            'channels': DIST_CHANNELS[distribution]}
+    checked = dict(base, packages=BASE_PKGS + ['conda', manager])
+    specs = read_env_specs(envfile)
+    prefixes = {spec['name']: f'{prefix}/envs/{spec["name"]}'
+                for spec in specs}
+    prefixes['base'] = prefix
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        listings = dict(zip(prefixes, pool.map(
+            lambda path: conda_list(path, distribution=distribution,
+                                    home=home, uid=uid, env=myenv),
+            prefixes.values())))
+    for spec in specs:
+        if not listings[spec['name']]:
+            print(f"[INFO] {spec['name']} is not installed, run install")
+    channels = sorted({ch for spec in specs + [base]
+                       for ch in spec['channels']})
+    # the newest versions, the indexed subdirs are refreshed too
+    db = repodata_index(channels, home=home, channel_alias=channel_alias,
+                        offline=offline, refresh=True)
+    updates = plan_updates([checked] + specs, listings, db)
+    db.close()
+    print(f'[PLAN] {len(updates)} of {len(prefixes)} envs with updates '
+          f'({time.time() - start:.1f}s)')
+    for envname, packages in sorted(updates.items()):
+        for name, installed, newer in packages:
+            print(f'    {envname:20} {name} {installed} -> {newer}')
+    if dry_run or not updates:
+        return []
+    specs = {spec['name']: spec for spec in specs}
+    specs['base'] = base
+
+    def update(envname):
+        spec = specs[envname]
+        cmd = [f'{prefix}/bin/{manager}', 'install', '-p', prefixes[envname]]
+        for channel in spec['channels']:
+            cmd += ['-c', channel]
+        cmd += [f'{name}={newer}' for name, _, newer in updates[envname]]
+        cmd += ['-y', '-q']
+        with cache_lock(home, distribution, manager=manager), \
+                env_lock(home, envname), \
+                profile_step(f'update:{envname}') as record:
+            res = create_env(envname, cmd, log_dir(home)/f'{envname}.log',
+                             env=myenv, uid=uid, timeout=timeout,
+                             append=True, cwd=f'{HOME_ROOT}/{home}/')
+            record['exit'] = res['status'] if res['status'] != 'ok' else 0
+        res['action'] = 'update'
+        if res['status'] == 'ok':
+            lock_store(home, spec, prefixes[envname],
+                       distribution=distribution, env=myenv, uid=uid)
+        print(f"[{res['status'].upper()}] {envname} "
+              f"({res['seconds']:.1f}s)")
+        return res
+
+    jobs = manager_jobs(manager, jobs)
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        results = list(pool.map(update, sorted(updates)))
+    print_envs_summary(results)
+    return [r for r in results if r['status'] != 'ok']
+
+
+def hash_index(home):
+    """Persistent SQLite index path -> (inode, size, mtime, sha256) used by
+    compact to hash only new or modified files"""
+    path = Path(f'{HOME_ROOT}/{home}')/'.seisbio'/'hashindex.sqlite'
+    path.parent.mkdir(parents=True, exist_ok=True)
+    db = sqlite3.connect(path)
+    db.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, '
+               'dev INTEGER, ino INTEGER, size INTEGER, mtime INTEGER, '
+               'sha256 TEXT)')
+    return db
+
+
+def prefix_unit(prefix, path):
+    """Name of the env (or 'base', 'pkgs') where path is"""
+    parts = Path(path).relative_to(prefix).parts
+    if parts[0] == 'envs' and len(parts) > 1:
+        return parts[1]
+    if parts[0] == 'pkgs':
+        return 'pkgs'
+    return 'base'
+
+
+def compact(distribution='miniforge', home='seisbio', uid=1015,
+            min_size=4096, dry_run=False):
+    """Hardlinks the identical files of the distribution (base, package
+    cache and every env) and removes the package tarballs.
+
+    Files are grouped by size and only the candidates are hashed, the
+    hashes are kept in hash_index so a rerun only hashes new files. Files
+    are linked only if they have the same owner and mode.
+
+    The files are replaced in place, so the package cache lock is taken
+    exclusive (shared with dry_run) for the whole compaction: no install
+    or update of the same home runs meanwhile.
+
+    Returns
+    -------
+    out : dict, env name -> bytes reclaimed
+    """
+    with cache_lock(home, distribution, shared=dry_run):
+        return compact_locked(distribution=distribution, home=home, uid=uid,
+                              min_size=min_size, dry_run=dry_run)
+
+
+def compact_locked(distribution='miniforge', home='seisbio', uid=1015,
+                   min_size=4096, dry_run=False):
+    """compact with the package cache lock taken"""
+    prefix = Path(f'{HOME_ROOT}/{home}/{distribution}')
+    db = hash_index(home)
+    by_size = {}
+    for root, dirs, files in os.walk(prefix):
+        for fname in files:
+            path = os.path.join(root, fname)
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            if stat.S_ISREG(st.st_mode) and st.st_size >= min_size:
+                by_size.setdefault(st.st_size, []).append((path, st))
+
+    def digest(path, st):
+        row = db.execute('SELECT dev, ino, size, mtime, sha256 FROM files '
+                         'WHERE path=?', (path,)).fetchone()
+        if row and row[:4] == (st.st_dev, st.st_ino, st.st_size,
+                               st.st_mtime_ns):
+            return row[4]
+        sha = file_sha256(path)
+        db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)',
+                   (path, st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns,
+                    sha))
+        return sha
+
+    reclaimed = {}
+    linked = 0
+    for size, candidates in by_size.items():
+        inodes = {(st.st_dev, st.st_ino) for _, st in candidates}
+        if len(inodes) < 2:
+            continue
+        by_hash = {}
+        for path, st in candidates:
+            by_hash.setdefault(digest(path, st), []).append((path, st))
+        for group in by_hash.values():
+            # the most linked inode stays, usually the package cache one
+            group.sort(key=lambda item: -item[1].st_nlink)
+            source, sst = group[0]
+            replaced = {}
+            for path, st in group[1:]:
+                if (st.st_dev, st.st_ino) == (sst.st_dev, sst.st_ino):
+                    continue
+                if (st.st_dev != sst.st_dev or st.st_mode != sst.st_mode or
+                        st.st_uid != sst.st_uid or st.st_gid != sst.st_gid):
+                    continue
+                if not dry_run:
+                    tmp = path + '.seis-tmp'
+                    os.link(source, tmp)
+                    os.replace(tmp, path)
+                linked += 1
+                key = (st.st_dev, st.st_ino)
+                replaced[key] = replaced.get(key, 0) + 1
+                # the space is free when the last link of the inode goes
+                if replaced[key] == st.st_nlink:
+                    unit = prefix_unit(prefix, path)
+                    reclaimed[unit] = reclaimed.get(unit, 0) + size
+    db.commit()
+    db.close()
+
+    tarballs = [entry for entry in os.scandir(prefix/'pkgs')
+                if entry.name.endswith(('.conda', '.tar.bz2'))] \
+        if (prefix/'pkgs').is_dir() else []
+    tar_bytes = sum(entry.stat().st_size for entry in tarballs)
+    if tarballs and not dry_run:
+        cmd = [str(prefix/'bin'/'conda'), 'clean', '--tarballs', '-y', '-q']
+        run_logged(cmd, log_dir(home)/'compact-clean.log', uid=uid)
+    if tar_bytes:
+        reclaimed['pkgs tarballs'] = tar_bytes
+
+    word = 'Would reclaim' if dry_run else 'Reclaimed'
+    print(f'[COMPACT] {linked} files hardlinked')
+    for unit, nbytes in sorted(reclaimed.items(), key=lambda kv: -kv[1]):
+        print(f'    {nbytes / 1e6:10.1f} MB  {unit}')
+    print(f'[COMPACT] {word} {sum(reclaimed.values()) / 1e6:.1f} MB')
+    return reclaimed
+
+
+def prefix_files(prefix):
+    """Files of prefix with the prefix path written in them.
+
+    The files recorded by conda (conda-meta paths_data with a
+    prefix_placeholder) plus the text scripts of bin/ that contain the
+    prefix, i.e. the pip entry points.
+
+    Returns
+    -------
+    out : dict, relative path -> 'text' | 'binary'
+    """
+    files = {}
+    for meta in (Path(prefix)/'conda-meta').glob('*.json'):
+        try:
+            record = json.loads(meta.read_text())
+        except ValueError:
+            continue
+        for path in record.get('paths_data', {}).get('paths', []):
+            if 'prefix_placeholder' in path:
+                files[path['_path']] = path.get('file_mode', 'text')
+    bprefix = str(prefix).encode()
+    bindir = Path(prefix)/'bin'
+    if bindir.is_dir():
+        for entry in os.scandir(bindir):
+            rel = f'bin/{entry.name}'
+            if rel in files or not entry.is_file(follow_symlinks=False):
+                continue
+            if entry.stat().st_size > 1 << 20:
+                continue
+            with open(entry.path, 'rb') as inf:
+                data = inf.read()
+            if b'\0' not in data[:8192] and bprefix in data:
+                files[rel] = 'text'
+    return files
+
+
+def relocate(path, files, old_prefix, prefix=None):
+    """Replaces old_prefix by prefix in files (see prefix_files) of the
+    prefix unpacked in path. prefix is path by default, they are only
+    different in staging directories. Binary files are padded with nulls,
+    so the new prefix cannot be longer than the old one in them.
+
+    Returns
+    -------
+    out : int, number of modified files
+    """
+    prefix = prefix or path
+    old = str(old_prefix).encode()
+    new = str(prefix).encode()
+    modified = 0
+    for rel, mode in files.items():
+        fpath = Path(path)/rel
+        if fpath.is_symlink() or not fpath.is_file():
+            continue
+        data = fpath.read_bytes()
+        if old not in data:
+            continue
+        if mode == 'binary':
+            if len(new) > len(old):
+                print(f'[WARN] {fpath}: binary file, {prefix} is longer '
+                      f'than {old_prefix}')
+                continue
+            data = re.sub(re.escape(old) + b'([^\0]*?)\0',
+                          lambda m: (new + m.group(1) +
+                                     b'\0' * (len(old) - len(new) + 1)),
+                          data)
+        else:
+            data = data.replace(old, new)
+        # write a new file, it may be a hardlink
+        tmp = fpath.with_name(fpath.name + '.seis-tmp')
+        tmp.write_bytes(data)
+        shutil.copystat(fpath, tmp)
+        os.replace(tmp, fpath)
+        modified += 1
+    return modified
+
+
+def pack_prefix(prefix, archive, exclude=()):
+    """Packs prefix in a tar.gz archive, hardlinks and symlinks are kept.
+
+    Keyword Arguments:
+    exclude -- top level names of prefix left out (i.e. envs, pkgs)
+    """
+    prefix = Path(prefix)
+    tmp = Path(str(archive) + '.tmp')
+    with tarfile.open(tmp, 'w:gz', compresslevel=6) as tar:
+        for entry in sorted(prefix.iterdir()):
+            if entry.name in exclude:
+                continue
+            tar.add(entry, arcname=entry.name)
+    os.replace(tmp, archive)
+
+
+def export_envs(distribution='miniforge', home='seisbio', outdir='.',
+                jobs=1):
+    """Packs the distribution (without envs and pkgs) and each env in
+    compressed archives with a manifest.json for deploy_envs.
+
+    Returns
+    -------
+    out : Path of the manifest
+    """
+    prefix = Path(f'{HOME_ROOT}/{home}/{distribution}')
+    outdir = Path(outdir)
+    outdir.mkdir(parents=True, exist_ok=True)
+    units = [('base', prefix, ('envs', 'pkgs'))]
+    envs_dir = prefix/'envs'
+    if envs_dir.is_dir():
+        units += [(env.name, env, ()) for env in sorted(envs_dir.iterdir())
+                  if (env/'conda-meta').is_dir()]
+
+    def pack(unit):
+        name, path, exclude = unit
+        archive = outdir/f'{name}.tar.gz'
+        with profile_step(f'export:{name}') as record:
+            pack_prefix(path, archive, exclude=exclude)
+            record['bytes'] = archive.stat().st_size
+        print(f'[PACKED] {name} ({archive.stat().st_size / 1e6:.1f} MB)')
+        return {'name': name,
+                'archive': archive.name,
+                'sha256': file_sha256(archive),
+                'size': archive.stat().st_size,
+                'packages': len(installed_packages(path)),
+                'prefix_files': prefix_files(path)}
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        entries = list(pool.map(pack, units))
+    manifest = {'distribution': distribution,
+                'prefix': str(prefix),
+                'platform': conda_platform(),
+                'created': time.time(),
+                'envs': entries}
+    path = outdir/'manifest.json'
+    path.write_text(json.dumps(manifest, indent=1))
+    print(f'[INFO] {len(entries)} archives and {path}')
+    return path
+
+
+def deploy_envs(artifacts, target, jobs=1, staging=None):
+    """Unpacks the archives of export_envs in target and fixes the prefix
+    in each of them, the envs in parallel.
+
+    Keyword Arguments:
+    artifacts -- directory with manifest.json and the archives
+    target    -- distribution prefix in this machine (local or shared
+                 filesystem) or an rsync destination host:/path. For rsync
+                 the archives are unpacked in staging with the final prefix
+                 already fixed and then copied with rsync. Only the deployed
+                 envs are mirrored (--delete), the package cache and the
+                 other envs of the target are kept. A temporary staging is
+                 removed at the end.
+    """
+    artifacts = Path(artifacts)
+    manifest = json.loads((artifacts/'manifest.json').read_text())
+    remote, temporary = None, False
+    # like rsync, a colon before the first slash, /data/a:b is local
+    if re.match(r'[^/]+:', str(target)):
+        remote = str(target)
+        target = remote.split(':', 1)[1]
+        temporary = staging is None
+        staging = Path(staging or tempfile.mkdtemp(prefix='seisbio-deploy-'))
+        destination = staging
     else:
-        print(f'[WARN] Unrecognized distribution: {args.distribution}')
-        sys.exit()
-    # user info
-    # user = os.getlogin()    # Error in some systems, glibc related?
-    user = getpass.getuser()
-    uid = os.getuid()
-    guid = os.getgid()
-    # Env file
-    if args.envfile == 'virtual_envs.txt':
+        destination = Path(target)
+    destination.mkdir(parents=True, exist_ok=True)
+    old_prefix = manifest['prefix']
+
+    def unpack(entry):
+        name = entry['name']
+        archive = artifacts/entry['archive']
+        if file_sha256(archive) != entry['sha256']:
+            raise DownloadError(f'{archive} is corrupted')
+        path = destination if name == 'base' else destination/'envs'/name
+        path.mkdir(parents=True, exist_ok=True)
+        with profile_step(f'deploy:{name}') as record:
+            with tarfile.open(archive) as tar:
+                if hasattr(tarfile, 'tar_filter'):
+                    tar.extractall(path, filter='tar')
+                else:
+                    tar.extractall(path)
+            # in staging the files get the final prefix, not the staging one
+            final = Path(target) if name == 'base' \
+                else Path(target)/'envs'/name
+            old = old_prefix if name == 'base' \
+                else f'{old_prefix}/envs/{name}'
+            record['files'] = relocate(path, entry['prefix_files'], old,
+                                       prefix=final)
+        print(f'[DEPLOYED] {name}')
+
+    entries = manifest['envs']
+    try:
+        # base first, the envs go inside it
+        unpack(entries[0])
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            list(pool.map(unpack, entries[1:]))
+        if remote:
+            print(f'[INFO] rsync to {remote}')
+            remote = remote.rstrip('/')
+            logfile = destination.parent/'seisbio-rsync.log'
+            # base without --delete: pkgs/ and the other envs stay
+            run_logged(['rsync', '-aH', '--exclude', '/envs/*',
+                        f'{destination}/', remote + '/'], logfile)
+            for entry in entries[1:]:
+                name = entry['name']
+                run_logged(['rsync', '-aH', '--delete',
+                            f'{destination}/envs/{name}/',
+                            f'{remote}/envs/{name}/'], logfile, append=True)
+    finally:
+        if temporary:
+            shutil.rmtree(staging, ignore_errors=True)
+    print(f'[INFO] {len(entries)} environments deployed in {target}')
+
+
+def update_bashrc(home, distribution, activation='conda'):
+    """Update the /etc/bash.bashrc and backup the original one
+
+    Keyword Arguments:
+    home         --
+    distribution --
+    activation   -- str (default 'conda')
+                    'conda': copy the conda initialize block of the
+                    distribution user .bashrc (starts conda in each shell).
+                    'static': source the snippet written by
+                    write_activation, no python process in each shell. It
+                    replaces the conda block added before by SEISbio.
+    """
+    # backup bashrcn, only the pristine one: reruns must not overwrite it
+    # with the file already modified by SEISbio
+    with open('/etc/bash.bashrc') as inf:
+        current = inf.read()
+    modified = ('# --- Added by SEISbio' in current or
+                '# >>> SEISbio static activation >>>' in current)
+    if not modified or not os.path.exists('/etc/bash.bashrc.backup'):
+        check_output(['cp', '/etc/bash.bashrc', '/etc/bash.bashrc.backup'])
+        with open('/etc/bash.bashrc.backup', 'a') as backuprc:
+            msg = ("\n\n# --- Backup of /bash.bashrc created\n"
+                   "# --- by SEISbio installation\n")
+            backuprc.write(msg)
+
+    if activation == 'static':
+        with open('/etc/bash.bashrc') as inf:
+            text = inf.read()
+        text = re.sub('\n*# --- Added by SEISbio\n'
+                      '# >>> conda initialize >>>.*?'
+                      '# <<< conda initialize <<<\n?', '\n', text,
+                      flags=re.DOTALL)
+        text = re.sub('\n*# >>> SEISbio static activation >>>.*?'
+                      '# <<< SEISbio static activation <<<\n?', '\n', text,
+                      flags=re.DOTALL)
+        block = ('# >>> SEISbio static activation >>>\n'
+                 f'[ -f {activation_dir(home)}/seis.sh ] && '
+                 f'. {activation_dir(home)}/seis.sh\n'
+                 '# <<< SEISbio static activation <<<\n')
+        with open('/etc/bash.bashrc', 'w') as bashrc:
+            bashrc.write(text.rstrip('\n') + '\n\n' + block)
+        return
+
+    # Get conda bashrc stringt RE
+    conda_re = re.compile('(# >>> conda initialize >>>.*'
+                          '# <<< conda initialize <<<)',
+                          re.DOTALL)
+    with open(f'{HOME_ROOT}/{home}/.bashrc') as inf:
+        text = inf.read()
+    try:
+        conda_text = conda_re.findall(text)[0]
+    except IndexError:
+        print(f'[WARN] Something is wrong with /home/{home}/.bashrc file!')
+        print('[EXIT!]')
+        exit()
+    # Update /etc/bash.bashrc
+    with open('/etc/bash.bashrc', 'a') as bashrc:
+        bashrc.write('\n\n# --- Added by SEISbio\n' + conda_text)
+
+
+def activation_dir(home):
+    """Directory of the static activation snippets"""
+    return Path(f'{HOME_ROOT}/{home}')/'.seisbio'/'activate'
+
+
+def shims_dir(home):
+    """Directory of the command shims, added to PATH by seis.sh"""
+    return Path(f'{HOME_ROOT}/{home}')/'.seisbio'/'bin'
+
+
+def env_commands(prefix, packages):
+    """Returns the bin/ commands installed by packages (names) in prefix,
+    read from their conda-meta records"""
+    commands = []
+    for meta in (Path(prefix)/'conda-meta').glob('*.json'):
+        if meta.stem.rsplit('-', 2)[0] not in packages:
+            continue
+        try:
+            record = json.loads(meta.read_text())
+        except ValueError:
+            continue
+        commands += [Path(fname).name for fname in record.get('files', [])
+                     if fname.startswith('bin/') and fname.count('/') == 1]
+    return sorted(set(commands))
+
+
+def write_activation(distribution='miniforge', home='seisbio', specs=(),
+                     force=False, lazy=False):
+    """Writes the static activation snippets and the command shims.
+
+    - activate/seis.sh: base distribution in PATH, the shims directory and
+      the activate-seis / deactivate-seis shell functions.
+    - activate/<env>.sh: static activation of each env (PATH, CONDA_PREFIX
+      and its etc/conda/activate.d scripts).
+    - bin/<command>: shim that activates the env and runs the command of
+      the env main packages (the spec packages).
+    - with lazy, bin/<command> of the specs not installed yet: shim that
+      installs the env on its first call (see materialize). The commands
+      are the spec 'commands' or the package names.
+
+    Nothing is written when the envs did not change since the last call
+    (fingerprint of the envs conda-meta records). The new files are
+    written in new directories swapped in at the end (see swap_dir), the
+    shims and snippets in use are never missing.
+
+    Returns
+    -------
+    out : bool, True if the snippets were written
+    """
+    prefix = Path(f'{HOME_ROOT}/{home}/{distribution}')
+    envs = {'base': prefix}
+    if (prefix/'envs').is_dir():
+        envs.update({env.name: env for env in sorted((prefix/'envs').iterdir())
+                     if (env/'conda-meta').is_dir()})
+    digest = hashlib.sha256()
+    for name, env in sorted(envs.items()):
+        digest.update(name.encode())
+        for meta in sorted(os.listdir(env/'conda-meta')):
+            digest.update(meta.encode())
+    for spec in specs:
+        digest.update(json.dumps(spec, sort_keys=True).encode())
+    digest.update(str(lazy).encode())
+    fingerprint = digest.hexdigest()
+    adir = activation_dir(home)
+    stamp = adir/'.fingerprint'
+    if not force and stamp.exists() and stamp.read_text() == fingerprint:
+        print('[INFO] Static activation is up to date')
+        return False
+    bdir = shims_dir(home)
+    # the files are written in new versions of the directories, the
+    # paths inside them are the final ones
+    adir.parent.mkdir(parents=True, exist_ok=True)
+    new_adir, new_bdir = (Path(tempfile.mkdtemp(prefix=f'{path.name}.',
+                                                dir=path.parent))
+                          for path in (adir, bdir))
+    for path in (new_adir, new_bdir):
+        path.chmod(0o755)
+
+    pending = {}
+    if lazy:
+        pending = {spec['name']: prefix/'envs'/spec['name'] for spec in specs
+                   if spec['name'] not in envs}
+    for name, env in list(envs.items()) + list(pending.items()):
+        with open(new_adir/f'{name}.sh', 'w') as out:
+            out.write(f'# Static activation of {name}, generated by SEISbio\n'
+                      'if [ -n "$SEIS_PATH_ORIG" ]; then '
+                      'PATH="$SEIS_PATH_ORIG"; '
+                      'else export SEIS_PATH_ORIG="$PATH"; fi\n'
+                      f'export PATH="{env}/bin:$PATH"\n'
+                      f'export CONDA_PREFIX="{env}"\n'
+                      f'export CONDA_DEFAULT_ENV="{name}"\n'
+                      f'for _seis_f in "{env}"/etc/conda/activate.d/*.sh; do\n'
+                      '    [ -f "$_seis_f" ] && . "$_seis_f"\n'
+                      'done\n'
+                      'unset _seis_f\n')
+    with open(new_adir/'seis.sh', 'w') as out:
+        out.write('# SEISbio static activation, generated by SEISbio\n'
+                  f'export PATH="{bdir}:{prefix}/bin:$PATH"\n'
+                  'activate-seis() {\n'
+                  f'    if [ -f "{adir}/${{1:-base}}.sh" ]; then\n'
+                  f'        . "{adir}/${{1:-base}}.sh"\n'
+                  '    else\n'
+                  '        echo "activate-seis: unknown environment $1" >&2\n'
+                  '        return 1\n'
+                  '    fi\n'
+                  '}\n'
+                  'deactivate-seis() {\n'
+                  '    [ -n "$SEIS_PATH_ORIG" ] && PATH="$SEIS_PATH_ORIG"\n'
+                  '    unset SEIS_PATH_ORIG CONDA_PREFIX CONDA_DEFAULT_ENV\n'
+                  '}\n')
+
+    shims = {}
+    for spec in specs:
+        if spec['name'] not in envs:
+            continue
+        names = [pkg.split('=')[0] for pkg in spec['packages']]
+        for command in env_commands(envs[spec['name']], names):
+            # the env named after the command wins
+            if command not in shims or command in spec['packages']:
+                shims[command] = spec['name']
+    for command, name in shims.items():
+        shim = new_bdir/command
+        shim.write_text('#!/bin/bash\n'
+                        f'# SEISbio shim: {command} from {name}\n'
+                        f'. "{adir}/{name}.sh"\n'
+                        f'exec "{envs[name]}/bin/{command}" "$@"\n')
+        shim.chmod(0o755)
+    lazy_shims = {}
+    for spec in specs:
+        if spec['name'] not in pending:
+            continue
+        names = spec.get('commands') or [pkg.split('=')[0]
+                                         for pkg in spec['packages']]
+        for command in names:
+            if command not in shims and command not in lazy_shims:
+                lazy_shims[command] = spec['name']
+    uid = os.stat(f'{HOME_ROOT}/{home}').st_uid
+    for command, name in lazy_shims.items():
+        env = pending[name]
+        materialize = (f'"{prefix}/bin/python" "{lazy_dir(home)}/'
+                       f'InstallSEISbio.py" materialize --home {home} '
+                       f'--home-root "{HOME_ROOT}" --homeid {uid} '
+                       f'-d {distribution} --env {name}')
+        shim = new_bdir/command
+        shim.write_text(
+            '#!/bin/bash\n'
+            f'# SEISbio lazy shim: {command} from {name}\n'
+            f'if [ ! -d "{env}/conda-meta" ]; then\n'
+            f'    echo "[SEISbio] Installing {name} on first use" >&2\n'
+            f'    if [ "$(id -u)" = "{uid}" ]; then\n'
+            f'        {materialize} >&2\n'
+            '    else\n'
+            f'        sudo -n -u {home} {materialize} >&2\n'
+            '    fi || exit 1\n'
+            'fi\n'
+            f'if [ ! -x "{env}/bin/{command}" ]; then\n'
+            f'    echo "{command} is not a command of {name}, '
+            f'see {bdir}" >&2\n'
+            '    exit 127\n'
+            'fi\n'
+            f'. "{adir}/{name}.sh"\n'
+            f'exec "{env}/bin/{command}" "$@"\n')
+        shim.chmod(0o755)
+    (new_adir/'.fingerprint').write_text(fingerprint)
+    swap_dir(adir, new_adir)
+    swap_dir(bdir, new_bdir)
+    print(f'[INFO] Static activation of {len(envs)} envs, '
+          f'{len(shims)} command shims in {bdir}')
+    if lazy_shims:
+        print(f'[INFO] {len(lazy_shims)} lazy shims of {len(pending)} envs '
+              'installed on first use')
+        if os.getuid() == 0 and os.getuid() != uid:
+            lazy_sudoers(distribution=distribution, home=home)
+    return True
+
+
+def swap_dir(path, new):
+    """Replaces the directory path by the directory new in one rename:
+    path is a symlink to its current version, readers find the old or the
+    new files, never a missing one. The old version is removed."""
+    path, new = Path(path), Path(new)
+    old = path.resolve() if path.is_symlink() else None
+    if path.is_dir() and not path.is_symlink():
+        # a directory written before the versions, moved away first
+        old = path.with_name(path.name + '.old')
+        shutil.rmtree(old, ignore_errors=True)
+        os.rename(path, old)
+    link = path.with_name(path.name + '.swap')
+    if os.path.lexists(link):
+        os.unlink(link)
+    os.symlink(new.name, link)
+    os.replace(link, path)
+    if old is not None and old != new.resolve():
+        shutil.rmtree(old, ignore_errors=True)
+
+
+def lazy_sudoers(distribution='miniforge', home='seisbio'):
+    """The lazy shims of the other users run materialize as the
+    distribution user with sudo -n, which needs a sudoers rule. The rule is
+    written to lazy/sudoers and printed for the administrator, without
+    sudo only the distribution user can install the lazy envs."""
+    python = f'{HOME_ROOT}/{home}/{distribution}/bin/python'
+    rule = (f'ALL ALL=({home}) NOPASSWD: {python} '
+            f'{lazy_dir(home)}/InstallSEISbio.py materialize *\n')
+    (lazy_dir(home)/'sudoers').write_text(rule)
+    if shutil.which('sudo') is None:
+        print('[WARN] sudo is not installed, the lazy shims of the users '
+              f'other than {home} fail on first use')
+        return
+    print('[ACTION] The lazy shims of the other users need this sudoers '
+          f"rule, i.e. in /etc/sudoers.d/seisbio (see {lazy_dir(home)}/"
+          'sudoers):')
+    print(f'    {rule}', end='')
+
+
+def lazy_dir(home):
+    """Directory of the env specs recorded by --lazy"""
+    return Path(f'{HOME_ROOT}/{home}')/'.seisbio'/'lazy'
+
+
+def write_lazy_specs(specs, home='seisbio'):
+    """Records the env specs for materialize, lazy/<env>.json, and copies
+    this script next to them for the lazy shims. The records of the envs
+    that are not in specs are removed."""
+    ldir = lazy_dir(home)
+    ldir.mkdir(parents=True, exist_ok=True)
+    names = {spec['name'] for spec in specs}
+    for record in ldir.glob('*.json'):
+        if record.stem not in names:
+            record.unlink()
+    for spec in specs:
+        (ldir/f"{spec['name']}.json").write_text(json.dumps(spec, indent=1))
+    shutil.copyfile(Path(__file__).absolute(), ldir/'InstallSEISbio.py')
+    print(f'[INFO] {len(specs)} env specs recorded in {ldir}')
+
+
+def lazy_specs(home='seisbio'):
+    """Env specs recorded by write_lazy_specs"""
+    return [json.loads(record.read_text())
+            for record in sorted(lazy_dir(home).glob('*.json'))]
+
+
+def chown_tree(path, uid):
+    """Gives path and everything inside to uid, the files written by root
+    that the distribution user updates later. Nothing to do if the
+    process already is the user (see chown_user)."""
+    if os.getuid() == uid:
+        return
+    for root, dirs, files in os.walk(path):
+        for name in [root] + [os.path.join(root, f) for f in dirs + files]:
+            os.lchown(name, uid, uid)
+
+
+def materialize(envnames=(), manager='mamba', distribution='miniforge',
+                home='seisbio', uid=1015, jobs=1, timeout=600):
+    """Installs recorded lazy envs (see write_lazy_specs), all of them
+    without envnames, and writes their real shims.
+
+    Called by the lazy shims on their first call. The env lock makes the
+    concurrent calls of the same env wait and reuse the first one, the
+    lockfile store avoids the solve when the env was solved before.
+
+    Returns
+    -------
+    out : list of dicts, see install_virtual_envs. Only the failed envs.
+    """
+    specs = {spec['name']: spec for spec in lazy_specs(home)}
+    unknown = [name for name in envnames if name not in specs]
+    if unknown:
+        print(f"[ERROR] No recorded spec for {', '.join(unknown)}")
+        return [{'env': name, 'status': 'unknown'} for name in unknown]
+    todo = [specs[name] for name in envnames] or list(specs.values())
+    failed = install_virtual_envs(todo, manager=manager,
+                                  distribution=distribution, home=home,
+                                  uid=uid, jobs=jobs, timeout=timeout)
+    with file_lock(locks_dir(home)/'activation.lock'):
+        write_activation(distribution=distribution, home=home,
+                         specs=list(specs.values()), lazy=True)
+    return failed
+
+
+def package_set_hash(prefix):
+    """Hash of the installed packages of prefix (conda-meta records), it
+    changes with any install, update or removal in the env"""
+    records = sorted(meta.name
+                     for meta in (Path(prefix)/'conda-meta').glob('*.json'))
+    return hashlib.sha256('\n'.join(records).encode()).hexdigest()
+
+
+def entry_probes(prefix, spec):
+    """Cheap commands that check the main entry point of an env, the first
+    package of spec: its command with --version and then -h or, without
+    commands, loading it in the env python (or R for r-* and
+    bioconductor-* packages)."""
+    name = spec['packages'][0].partition('=')[0]
+    commands = env_commands(prefix, [name])
+    if commands:
+        same = [cmd for cmd in commands if cmd.lower() == name.lower()]
+        command = str(Path(prefix)/'bin'/(same or commands)[0])
+        return [[command, '--version'], [command, '-h']]
+    rscript = Path(prefix)/'bin'/'Rscript'
+    if name.startswith(('r-', 'bioconductor-')) and rscript.exists():
+        library = name.split('-', 1)[1]
+        # conda names are lowercase, R ones are not: bioconductor-deseq2
+        # is DESeq2
+        rlib = Path(prefix)/'lib'/'R'/'library'
+        if rlib.is_dir():
+            library = next((entry.name for entry in rlib.iterdir()
+                            if entry.name.lower() == library.lower()),
+                           library)
+        return [[str(rscript), '-e', f'library({library})']]
+    python = Path(prefix)/'bin'/'python'
+    if python.exists():
+        return [[str(python), '-c', f"import {name.replace('-', '_')}"]]
+    return []
+
+
+def probe_env(prefix, spec, uid=1015, timeout=30):
+    """Runs the entry_probes of the env as if it was activated, the first
+    one that exits with 0 passes the env.
+
+    Returns
+    -------
+    out : dict, status ('pass', 'fail' or 'skip'), probe command, wall
+          time in seconds and the last output lines of a failure
+    """
+    myenv = os.environ.copy()
+    myenv['PATH'] = f"{prefix}/bin:{myenv.get('PATH', '')}"
+    myenv['CONDA_PREFIX'] = str(prefix)
+    start = time.time()
+    result = {'status': 'skip', 'probe': None, 'output': ''}
+    for cmd in entry_probes(prefix, spec):
+        result = {'status': 'fail', 'probe': ' '.join(cmd)}
+        try:
+            proc = run(cmd, stdin=DEVNULL, stdout=PIPE, stderr=STDOUT,
+                       env=myenv, **as_user(uid),
+                       timeout=timeout)
+        except TimeoutExpired:
+            result['output'] = f'timeout after {timeout}s'
+            continue
+        except OSError as err:
+            result['output'] = str(err)
+            continue
+        output = proc.stdout.decode(errors='replace').splitlines()
+        result['output'] = '\n'.join(output[-RUNNER['tail']:])
+        if proc.returncode == 0:
+            result['status'] = 'pass'
+            break
+    result['seconds'] = time.time() - start
+    return result
+
+
+def verify_envs(specs, distribution='miniforge', home='seisbio', uid=1015,
+                jobs=1, timeout=30):
+    """Smoke test of the env entry points (see probe_env) on a worker pool.
+
+    The results are cached in /home/<home>/.seisbio/verify.json with the
+    package set hash of each env (see package_set_hash), the envs that
+    passed and did not change since are not probed again. The health
+    report is written in /home/<home>/.seisbio/reports/health-*.json.
+
+    Returns
+    -------
+    out : list of dicts, the envs that failed or are not installed
+    """
+    envs_path = Path(f'{HOME_ROOT}/{home}')/distribution/'envs'
+    cache_path = Path(f'{HOME_ROOT}/{home}')/'.seisbio'/'verify.json'
+    try:
+        cache = json.loads(cache_path.read_text())
+    except (OSError, ValueError):
+        cache = {}
+    start = time.time()
+
+    def verify(spec):
+        prefix = envs_path/spec['name']
+        if not (prefix/'conda-meta').is_dir():
+            return {'env': spec['name'], 'status': 'missing', 'probe': None,
+                    'output': f'{prefix} does not exist', 'seconds': 0.0}
+        key = package_set_hash(prefix)
+        cached = cache.get(spec['name'])
+        if cached and cached['key'] == key and cached['status'] == 'pass':
+            return dict(cached, cached=True)
+        with profile_step(f"verify:{spec['name']}") as record:
+            result = probe_env(prefix, spec, uid=uid, timeout=timeout)
+            record['exit'] = 0 if result['status'] != 'fail' else 'fail'
+        return dict(result, env=spec['name'], key=key, cached=False)
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        results = list(pool.map(verify, specs))
+    cache.update({res['env']: res for res in results if 'key' in res})
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    cache_path.write_text(json.dumps(cache, indent=1))
+    report_dir = Path(f'{HOME_ROOT}/{home}')/'.seisbio'/'reports'
+    report_dir.mkdir(parents=True, exist_ok=True)
+    report = report_dir/f"health-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    counts = {status: sum(1 for r in results if r['status'] == status)
+              for status in ('pass', 'skip', 'fail', 'missing')}
+    report.write_text(json.dumps({'created': time.time(),
+                                  'host': platform.node(),
+                                  'distribution': distribution,
+                                  'summary': counts,
+                                  'envs': results}, indent=1))
+    print('[VERIFY] Environments')
+    for res in sorted(results, key=lambda r: (r['status'], r['env'])):
+        mark = ' (cached)' if res.get('cached') else ''
+        print(f"    {res['status']:8} {res['env']:25} "
+              f"{res['probe'] or '-'}{mark}")
+        if res['status'] in ('fail', 'missing'):
+            for line in res['output'].splitlines()[-5:]:
+                print(f'             | {line}')
+    failed = [r for r in results if r['status'] in ('fail', 'missing')]
+    probed = sum(1 for r in results if r.get('cached') is False)
+    print(f"[VERIFY] {counts['pass']} ok, {counts['skip']} not probed (no "
+          f"entry point), {len(failed)} failed, {probed} probed "
+          f"({time.time() - start:.1f}s)")
+    print(f'[VERIFY] Report: {report}')
+    return failed
+
+
+def journal_path(home):
+    """Provisioning journal file"""
+    return Path(f'{HOME_ROOT}/{home}')/'.seisbio'/'journal.json'
+
+
+def journal_load(home):
+    """Returns the journal of the last run or an empty one.
+
+    The journal is a dict with:
+    stages  -- finished stage name -> finishing time
+    envs    -- finished env name -> spec hash (see lock_key)
+    answers -- interactive answers and state needed to resume
+    """
+    journal = {'stages': {}, 'envs': {}, 'answers': {}}
+    try:
+        journal.update(json.loads(journal_path(home).read_text()))
+    except (OSError, ValueError):
+        pass
+    return journal
+
+
+def journal_save(home, journal):
+    """Writes the journal atomically. Nothing is written while the
+    distribution home does not exist (before the user stage)."""
+    if not Path(f'{HOME_ROOT}/{home}').exists():
+        return
+    path = journal_path(home)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix('.tmp')
+    tmp.write_text(json.dumps(journal, indent=1))
+    os.replace(tmp, path)
+
+
+def journal_record(home, journal, section, key, value=None):
+    """Records a finished item in a journal section and saves it. Safe to
+    call from the install_virtual_envs workers."""
+    with JOURNAL_LOCK:
+        journal[section][key] = time.time() if value is None else value
+        journal_save(home, journal)
+
+
+def create_user(home, homeid):
+    """Creates the distribution user (asks for its password)"""
+    print(f'[INFO] Creating {home} user and asking for a password.')
+    print('=====================')
+    # adduser only works this way in Debian distrso
+    # ArchLinux : install adduser-deb from AUR
+    # cmd_create = f"""adduser --shell /bin/bash --uid 1015 --gecos '' {home}""".split()
+    # run(cmd_create)
+    cmd_create = (f"useradd -s /bin/bash -u {homeid} -m "
+                  f"-d {HOME_ROOT}/{home} {home}").split()
+    check_output(cmd_create)
+    # password
+    print(f'[INFO] Configuring {home} user.')
+    print(f'[INPUT] Enter {home} user password:')
+    cmd_passwd = ['passwd', home]
+    check_output(cmd_passwd)
+    # permissions
+    cmd_chmod = ['chmod', '-R', 'go+r', f'{HOME_ROOT}/{home}']
+    check_output(cmd_chmod)
+    cmd_chmod = ['chmod', 'go+x', f'{HOME_ROOT}/{home}']
+    check_output(cmd_chmod)
+
+    print('=====================')
+    print(f'[INFO] {home} user created')
+    print('=====================')
+
+
+def ask_answers(args, system_wide=True):
+    """Interactive questions of the installation, asked before any stage
+    runs so a resumed run does not ask them again.
+
+    Returns
+    -------
+    out : dict, question -> 'y' | 'n'
+    """
+    answers = {}
+    if system_wide and os.path.exists(f'{HOME_ROOT}/{args.home}'):
+        print(f'[WARN] {args.home} user already exists!!!')
+        print('[INFO] Consider to delete this user')
+        print(f'   $ sudo userdel -r {args.home}')
+        answer = input("Do you want to continue? y/[n]: ")
+        if answer == 'y':
+            print('[INFO] Continue installation')
+        elif answer == 'n':
+            print('[END] exit program doing nothing more!')
+            exit()
+        else:
+            print('[END] Invalid answer: exit!')
+            exit()
+        answers['continue'] = answer
+    if os.path.exists(f'{HOME_ROOT}/{args.home}/{args.distribution}'):
+        print(f'[INFO] {args.distribution} already installed.')
+        answer = input(f'Do you want to update base {args.distribution}'
+                       ' installation? y/[n]')
+        if answer not in ('y', 'n'):
+            print('[END] Invalid answer: exit!')
+            exit()
+        answers['update_base'] = answer
+    else:
+        answers['update_base'] = 'y'
+    return answers
+
+
+def use_system_installation(shared_home, home, distribution, softlink=False):
+    """Registers the package cache and lockfile store of the system wide
+    installation in /home/<shared_home> as SHARED read-only stores of the
+    local installation in /home/<home> (see pkgs_env and lock_lookup).
+
+    Returns
+    -------
+    out : bool, False if there is no readable system installation.
+    """
+    pkgs = Path(f'{HOME_ROOT}/{shared_home}')/distribution/'pkgs'
+    if shared_home == home or not os.access(pkgs, os.R_OK | os.X_OK):
+        print(f'[INFO] No system package cache in {pkgs}, all the packages'
+              ' will be downloaded.')
+        return False
+    SHARED['pkgs'] = [str(pkgs)]
+    SHARED['locks'] = [str(lock_dir(shared_home))]
+    SHARED['softlink'] = softlink
+    print(f'[INFO] Using {pkgs} as read-only package cache.')
+    if not softlink and not hardlinks_allowed(pkgs, f'{HOME_ROOT}/{home}'):
+        print(f'[WARN] The files of {pkgs} can not be hardlinked by '
+              f'{getpass.getuser()}, they will be copied. Use --softlink '
+              'to link them.')
+    return True
+
+
+def hardlinks_allowed(source_dir, dest_dir):
+    """True if this user can hardlink the files of source_dir in dest_dir,
+    the same filesystem and, with fs.protected_hardlinks, own files."""
+    if os.stat(source_dir).st_dev != os.stat(dest_dir).st_dev:
+        return False
+    try:
+        protected = Path('/proc/sys/fs/protected_hardlinks').read_text()
+    except OSError:
+        protected = '0'
+    owner = os.stat(source_dir).st_uid
+    return protected.strip() != '1' or owner == os.getuid()
+
+
+def envfile_path(envfile):
+    """Returns the absolute path of the env file argument"""
+    if envfile == 'virtual_envs.txt':
         # default file
         mypath = Path(__file__)
-        envfile = mypath.parent.absolute()/args.envfile
+        envfile = mypath.parent.absolute()/envfile
         print('     ... from default file:')
         print(f'     ... {envfile}')
     else:
-        envfile = Path().absolute()/args.envfile
+        envfile = Path().absolute()/envfile
         print('     ... from file:')
         print(f'     ... {envfile}')
+    return envfile
+
+
+def main():
+    global HOME_ROOT
+    # TODO (acph) ask if superuser
+    args = arguments()
+    HOME_ROOT = args.home_root.rstrip('/') or '/'
+    if args.distribution not in ('miniforge', 'miniconda'):
+        print(f'[WARN] Unrecognized distribution: {args.distribution}')
+        sys.exit()
+    # lockfile store commands
+    if args.command == 'lock-list':
+        lock_list(args.home)
+        sys.exit()
+    elif args.command == 'lock-evict':
+        lock_evict_stale(args.home, max_age=args.max_age)
+        sys.exit()
+    if args.command == 'check':
+        ok = run_preflight(envfile_path(args.envfile), home=args.home,
+                           channel_alias=args.channel_alias,
+                           offline=args.offline,
+                           refresh=args.refresh_index)
+        sys.exit(0 if ok else 1)
+    if args.command == 'update':
+        manager = 'mamba' if args.distribution == 'miniforge' else 'conda'
+        failed = update_envs(envfile_path(args.envfile), manager=manager,
+                             distribution=args.distribution, home=args.home,
+                             uid=args.homeid, jobs=args.jobs,
+                             channel_alias=args.channel_alias,
+                             offline=args.offline, dry_run=args.dry_run,
+                             timeout=args.timeout)
+        sys.exit(1 if failed else 0)
+    if args.command == 'verify':
+        failed = verify_envs(read_env_specs(envfile_path(args.envfile)),
+                             distribution=args.distribution, home=args.home,
+                             uid=args.homeid, jobs=args.jobs)
+        sys.exit(1 if failed else 0)
+    if args.command == 'materialize':
+        manager = 'mamba' if args.distribution == 'miniforge' else 'conda'
+        failed = materialize(args.env, manager=manager,
+                             distribution=args.distribution, home=args.home,
+                             uid=args.homeid, jobs=args.jobs,
+                             timeout=args.timeout)
+        sys.exit(1 if failed else 0)
+    if args.command == 'compact':
+        compact(distribution=args.distribution, home=args.home,
+                uid=args.homeid, dry_run=args.dry_run)
+        sys.exit()
+    # fleet provisioning
+    if args.command == 'export':
+        export_envs(distribution=args.distribution, home=args.home,
+                    outdir=args.artifacts, jobs=args.jobs)
+        sys.exit()
+    elif args.command == 'deploy':
+        target = args.target or f'{HOME_ROOT}/{args.home}/{args.distribution}'
+        deploy_envs(args.artifacts, target, jobs=args.jobs)
+        sys.exit()
+    # user info
+    # user = os.getlogin()    # Error in some systems, glibc related?
+    user = getpass.getuser()
+    uid = os.getuid()
+    guid = os.getgid()
 
     # Isntalling
     if args.local:
         # TODO (acph) sub menus or warning of ignoring arguments
         print('[INFO] Installing systemm locally')
         print(f'[INFO] in  user {user} (uid: {uid}, gid:{guid})')
+        args.shared_home = args.home
         args.home = user
         args.homeid = uid
-        install(args)
-        print('------ but no yet --------')
-        print('------ working on it -----')
+        install(args, system_wide=False)
         sys.exit()
     else:
-        if uid != 0:
+        if uid != 0 and not args.plan:
             print('[INFO] You need to be root to install SEIS system wide'
                   ' or use --local flag for local installation.')
             print(f'       You are {user}!')
@@ -392,117 +3698,17 @@ def main():
             sys.exit()
 
     print('============ Installing as root')
-    if args.debian:
-        print('[START] Installing system packages for Debian/Ubuntu.')
-        debian_install_bioinfo(upgrade=args.debupgrade)
-
-    # creating seisbio user
-    print(f'[INFO] Creating {args.home} user if not exists.')
-    if not os.path.exists(f'/home/{args.home}'):
-        print(f'[INFO] Creating {args.home} user and asking for a password.')
-        print('=====================')
-        # adduser only works this way in Debian distrso
-        # ArchLinux : install adduser-deb from AUR
-        # cmd_create = f"""adduser --shell /bin/bash --uid 1015 --gecos '' {args.home}""".split()
-        # run(cmd_create)
-        cmd_create = f"useradd -s /bin/bash -u {args.homeid} -m {args.home}".split()
-        check_output(cmd_create)
-        # password
-        print(f'[INFO] Configuring {args.home} user.')
-        print(f'[INPUT] Enter {args.home} user password:')
-        cmd_passwd = ['passwd', args.home]
-        check_output(cmd_passwd)
-        # permissions
-        cmd_chmod = ['chmod', '-R', 'go+r', f'/home/{args.home}']
-        check_output(cmd_chmod)
-        cmd_chmod = ['chmod', 'go+x', f'/home/{args.home}']
-        check_output(cmd_chmod)
-
-        print('=====================')
-        print(f'[INFO] {args.home} user created')
-        print('=====================')
-    else:
-        print(f'[WARN] {args.home} user already exists!!!')
-        print('[INFO] Consider to delete this user')
-        print(f'   $ sudo userdel -r {args.home}')
-        answer = input("Do you want to continue? y/[n]: ")
-        if answer == 'y':
-            print('[INFO] Continue installation')
-        elif answer == 'n':
-            print('[END] exit program doing nothing more!')
-            exit()
-        else:
-            print('[END] Invalid answer: exit!')
-            exit()
+    install(args, system_wide=True)
 
-    print(f'[INFO] Moving to {args.home} home')
-    os.chdir(f'/home/{args.home}/')
-    print('=====================')
-    print(f'[INFO] Downloading {args.distribution} distribution')
-
-    installerfilename = donwload_distribution(distribution=args.distribution,
-                                              uid=args.homeid,
-                                              home=args.home)
-
-    if not os.path.exists(f'/home/{args.home}/{args.distribution}'):
-        print(f'[INFO] Installing {args.distribution}.')
-        install_distribution(installerfilename, distribution=args.distribution,
-                             home=args.home, uid=args.homeid)
-        print('[INFO] Updating /etc/bash.bashrc')
-        update_bashrc(args.home, args.distribution)
-        installed = False
-    else:
-        installed = True
-        print(f'[INFO] {args.distribution} already isntalled.')
-
-    if installed:
-        answer_installed = input(f'Do you want to update base {args.distribution}'
-                                 ' installation? y/[n]')
-        if answer_installed == 'y':
-            print('[INFO] Updating anaconda and isntalling basic packages.')
-            update_distribution(manager=manager,
-                                distribution=args.distribution,
-                                home=args.home,
-                                uid=args.homeid
-                                )
-            print('[INFO] Installing base scientific packages.')
-            install_distribution_base(manager=manager,
-                                      distribution=args.distribution,
-                                      home=args.home,
-                                      uid=args.homeid
-                                      )
-        elif answer_installed == 'n':
-            print('[INFO]  Continue with envs installation!')
-        else:
-            print('[END] Invalid answer: exit!')
-            exit()
-    else:
-        print('[INFO] Updating anaconda and isntalling basic packages.')
-        update_distribution(manager=manager,
-                            distribution=args.distribution,
-                            home=args.home,
-                            uid=args.homeid
-                            )
-        print('[INFO] Installing base scientific packages.')
-        install_distribution_base(manager=manager,
-                                  distribution=args.distribution,
-                                  home=args.home,
-                                  uid=args.homeid
-                                  )
-
-    print('[INFO] virtual envs.')
-    # envfile defintion at the begining of main()b
-    env_list = read_env_file(envfile)
-    install_virtual_envs(env_list,
-                         manager=manager,
-                         distribution=args.distribution,
-                         home=args.home,
-                         uid=args.homeid
-                         )
-    print('[END] All packages instaled')
 
+def install(args, system_wide=True):
+    """Runs the installation stages recording each finished stage in the
+    journal. With args.resume the stages and envs finished by the previous
+    run are skipped and its answers are reused. With args.plan only the
+    stages graph is printed.
 
-def install(args):
+    See provisioning_stages.
+    """
     # Distribution
     if args.distribution == 'miniforge':
         manager = 'mamba'
@@ -512,78 +3718,322 @@ def install(args):
         print(f'[WARN] Unrecognized distribution: {args.distribution}')
         sys.exit()
     # envfile
-    if args.envfile == 'virtual_envs.txt':
-        # default file
-        mypath = Path(__file__)
-        envfile = mypath.parent.absolute()/args.envfile
-        print('     ... from default file:')
-        print(f'     ... {envfile}')
-    else:
-        envfile = Path().absolute()/args.envfile
-        print('     ... from file:')
-        print(f'     ... {envfile}')
+    envfile = envfile_path(args.envfile)
+    if args.lazy:
+        # the lazy shims are static activation shims
+        args.activation = 'static'
 
-    print(f'[INFO] Downloading {args.distribution} distribution.')
-    installerfilename = donwload_distribution(distribution=args.distribution,
-                                              uid=args.homeid,
-                                              home=args.home)
-
-    if not os.path.exists(f'/home/{args.home}/{args.distribution}'):
-        print(f'[INFO] Installing {args.distribution}.')
-        install_distribution(installerfilename, distribution=args.distribution,
-                             home=args.home, uid=args.homeid)
-        # print('[INFO] Updating /etc/bash.bashrc')
-        # update_bashrc(args.home, args.distribution)
-        installed = False
+    if args.resume:
+        journal = journal_load(args.home)
+        print(f"[INFO] Resuming, {len(journal['stages'])} stages and "
+              f"{len(journal['envs'])} envs already done.")
     else:
-        installed = True
-        print(f'[INFO] {args.distribution} already installed.')
+        journal = {'stages': {}, 'envs': {}, 'answers': {}}
+    stages = provisioning_stages(args, manager, envfile, journal,
+                                 system_wide=system_wide)
+    if args.plan:
+        print_plan(stages, done=journal['stages'])
+        return
+    if args.preflight and not run_preflight(
+            envfile, home=args.home, channel_alias=args.channel_alias,
+            offline=args.offline, refresh=args.refresh_index):
+        print('[END] Fix the env file before installing.')
+        sys.exit(1)
+    if not journal['answers']:
+        journal['answers'].update(ask_answers(args,
+                                              system_wide=system_wide))
+    journal_save(args.home, journal)
+
+    for name in journal['stages']:
+        print(f'[RESUME] Stage {name} already done.')
+    shared_lock = nullcontext()
+    if args.shared_home and use_system_installation(
+            args.shared_home, args.home, args.distribution,
+            softlink=args.softlink):
+        # the system cache is not cleaned while it is linked from
+        shared_lock = system_cache_lock(args.shared_home, args.distribution)
+    PROFILE['enabled'] = args.profile
+    RUNNER['progress'] = args.progress
+    RUNNER['tail'] = args.tail
+
+    def timed(name, function):
+        def stage():
+            with profile_step(f'stage:{name}'):
+                function()
+        return stage
+
+    stages = {name: (timed(name, function), deps)
+              for name, (function, deps) in stages.items()}
+    with shared_lock:
+        failed = run_stages(stages, done=journal['stages'],
+                            on_done=lambda name: journal_record(
+                                args.home, journal, 'stages', name))
+    if args.profile:
+        write_profile(args.home)
+    if failed:
+        for name, err in failed.items():
+            if not isinstance(err, (CalledProcessError, TimeoutExpired,
+                                    StageError)):
+                # unexpected errors, the message alone can be unclear
+                err = f'{type(err).__name__}: {err}'
+            print(f'[ERROR] Stage {name} failed: {err}')
+        print('[END] Run again with --resume to continue from here.')
+        sys.exit(1)
+    print('[END] All packages instaled')
+
+
+def provisioning_stages(args, manager, envfile, journal, system_wide=True):
+    """Returns the installation stages graph for run_stages.
+
+    Stages: user, debian (if args.debian), arch (if args.arch), download,
+    install, bashrc, update, prefetch (with --prefetch), base, envs,
+    activation (with --activation static) and verify (with --verify). The
+    local installation has no debian, arch, user and bashrc stages, it
+    reuses the system wide installation of args.shared_home (see
+    use_system_installation).
+    """
+    answers = journal['answers']
+
+    def stage_debian():
+        print('[START] Installing system packages for Debian/Ubuntu.')
+        debian_install_bioinfo(upgrade=args.debupgrade,
+                               logs=log_dir(args.home))
+
+    def stage_arch():
+        print('[START] Installing system packages for ArchLinux.')
+        arch_install_bioinfo(upgrade=args.debupgrade,
+                             logs=log_dir(args.home), home=args.home,
+                             uid=args.homeid, jobs=args.jobs,
+                             aur_dir=args.aur_dir, cache_dir=args.aur_cache)
+
+    def stage_user():
+        # creating seisbio user
+        print(f'[INFO] Creating {args.home} user if not exists.')
+        if not os.path.exists(f'{HOME_ROOT}/{args.home}'):
+            create_user(args.home, args.homeid)
+            # the home exists now, save what was done before
+            journal_save(args.home, journal)
+
+    def stage_download():
+        print(f'[INFO] Downloading {args.distribution} distribution.')
+        system_copy = (f'{HOME_ROOT}/{args.shared_home}/'
+                       f'{installer_filename(args.distribution)}')
+        if (args.shared_home and args.mirror is None and
+                os.access(system_copy, os.R_OK)):
+            # installer of the system wide installation, verified against
+            # the published checksum
+            sha256 = (args.installer_sha256 or
+                      fetch_sha256(DIST_URLS[args.distribution] + '.sha256'))
+            mirror = f'file://{HOME_ROOT}/{args.shared_home}'
+            try:
+                donwload_distribution(distribution=args.distribution,
+                                      uid=args.homeid, home=args.home,
+                                      mirror=mirror,
+                                      cache_dir=args.download_cache,
+                                      sha256=sha256)
+                return
+            except DownloadError as err:
+                print(f'[WARN] System installer not used: {err}')
+        donwload_distribution(distribution=args.distribution,
+                              uid=args.homeid, home=args.home,
+                              mirror=args.mirror,
+                              cache_dir=args.download_cache,
+                              sha256=args.installer_sha256)
+
+    def stage_install():
+        if not os.path.exists(f'{HOME_ROOT}/{args.home}/{args.distribution}'):
+            print(f'[INFO] Installing {args.distribution}.')
+            install_distribution(installer_filename(args.distribution),
+                                 distribution=args.distribution,
+                                 home=args.home, uid=args.homeid)
+            answers['fresh_install'] = True
+        else:
+            print(f'[INFO] {args.distribution} already installed.')
+
+    def stage_bashrc():
+        if answers.get('fresh_install') or args.activation == 'static':
+            print('[INFO] Updating /etc/bash.bashrc')
+            update_bashrc(args.home, args.distribution,
+                          activation=args.activation)
+
+    def stage_activation():
+        specs = read_env_specs(envfile)
+        write_activation(distribution=args.distribution, home=args.home,
+                         specs=specs, lazy=args.lazy)
+        if args.lazy:
+            # materialize runs as the distribution user
+            chown_tree(f'{HOME_ROOT}/{args.home}/.seisbio', args.homeid)
+
+    def stage_prefetch():
+        print('[INFO] Prefetching the packages of the envs.')
+        prefetch_packages(read_env_specs(envfile), manager=manager,
+                          distribution=args.distribution, home=args.home,
+                          uid=args.homeid, jobs=args.jobs,
+                          workers=args.fetch_jobs,
+                          refresh_locks=args.refresh_locks,
+                          base=answers['update_base'] == 'y',
+                          timeout=args.timeout)
 
-    if installed:
-        answer_installed = input('Do you want to update base {args.distribution}'
-                                 ' installation? y/[n]')
-        if answer_installed == 'y':
+    def stage_verify():
+        failed = verify_envs(read_env_specs(envfile),
+                             distribution=args.distribution, home=args.home,
+                             uid=args.homeid, jobs=args.jobs)
+        if failed:
+            raise StageError(f'{len(failed)} environments do not work, '
+                             'see the health report')
+
+    def stage_update():
+        if answers['update_base'] == 'y':
             print('[INFO] Updating anaconda and isntalling basic packages.')
             update_distribution(manager=manager,
                                 distribution=args.distribution,
                                 home=args.home,
-                                uid=args.homeid
+                                uid=args.homeid,
+                                timeout=args.timeout
                                 )
-            print('[INFO] Installing scientific packages.')
+        else:
+            print('[INFO]  Continue with envs installation!')
+
+    def stage_base():
+        if answers['update_base'] == 'y':
+            print('[INFO] Installing base scientific packages.')
             install_distribution_base(manager=manager,
                                       distribution=args.distribution,
                                       home=args.home,
-                                      uid=args.homeid
+                                      uid=args.homeid,
+                                      refresh_locks=args.refresh_locks,
+                                      timeout=args.timeout
                                       )
-        elif answer_installed == 'n':
-            print('[INFO]  Continue with envs installation!')
-        else:
-            print('[END] Invalid answer: exit!')
-            exit()
-    else:
-        print('[INFO] Updating anaconda and isntalling basic packages.')
-        update_distribution(manager=manager,
-                            distribution=args.distribution,
-                            home=args.home,
-                            uid=args.homeid
-                            )
-        print('[INFO] Installing base scientific packages.')
-        install_distribution_base(manager=manager,
-                                  distribution=args.distribution,
-                                  home=args.home,
-                                  uid=args.homeid
-                                  )
-
-    print('[INFO] virtual envs.')
-    # envfile defintion at the begining of main()b
-    env_list = read_env_file(envfile)
-    install_virtual_envs(env_list,
-                         manager=manager,
-                         distribution=args.distribution,
-                         home=args.home,
-                         uid=args.homeid
-                         )
-    print('[END] All packages instaled')
+
+    def stage_envs():
+        print('[INFO] virtual envs.')
+        # envfile defintion at the begining of install()
+        env_list = read_env_specs(envfile)
+        if args.lazy:
+            write_lazy_specs(env_list, home=args.home)
+            return
+        failed = install_virtual_envs(env_list,
+                                      manager=manager,
+                                      distribution=args.distribution,
+                                      home=args.home,
+                                      uid=args.homeid,
+                                      jobs=args.jobs,
+                                      refresh_locks=args.refresh_locks,
+                                      prune=args.prune,
+                                      timeout=args.timeout,
+                                      journal=journal,
+                                      templates=args.templates
+                                      )
+        if failed:
+            raise StageError(f'{len(failed)} environments failed, '
+                             'check the logs')
+
+    stages = {'user': (stage_user, []),
+              # apt runs while the distribution is downloaded and installed,
+              # after the user stage because passwd is interactive
+              'debian': (stage_debian, ['user']),
+              # makepkg runs as the distribution user
+              'arch': (stage_arch, ['user']),
+              'download': (stage_download, ['user']),
+              'install': (stage_install, ['download']),
+              'bashrc': (stage_bashrc, ['install']),
+              'update': (stage_update, ['install']),
+              # all the downloads before base and envs start linking
+              'prefetch': (stage_prefetch, ['update']),
+              'base': (stage_base, ['update', 'prefetch']),
+              # the env commands run conda of base, it cannot be replaced
+              # by the base install meanwhile
+              'envs': (stage_envs, ['base']),
+              'activation': (stage_activation, ['base', 'envs']),
+              'verify': (stage_verify, ['envs'])}
+    if not (system_wide and args.debian):
+        del stages['debian']
+    if not (system_wide and args.arch):
+        del stages['arch']
+    if not args.verify:
+        del stages['verify']
+    if not args.prefetch or args.lazy:
+        del stages['prefetch']
+    if args.activation != 'static':
+        del stages['activation']
+    if not system_wide:
+        del stages['user']
+        del stages['bashrc']
+    return stages
+
+
+def print_plan(stages, done=()):
+    """Prints the stages graph. Stages in the same level have all their
+    dependencies in previous levels and run at the same time."""
+    levels = stage_levels(stages)
+    print('[PLAN] Provisioning stages')
+    for name in sorted(stages, key=lambda n: (levels[n], n)):
+        deps = [dep for dep in stages[name][1] if dep in stages]
+        mark = ' (done)' if name in done else ''
+        print(f"    {levels[name]}  {name:10} <- {', '.join(deps) or '-'}"
+              f"{mark}")
+
+
+def stage_levels(stages):
+    """Returns a dict stage name -> level in the dependency graph"""
+    levels = {}
+
+    def level(name):
+        if name not in levels:
+            deps = [dep for dep in stages[name][1] if dep in stages]
+            levels[name] = 1 + max((level(dep) for dep in deps), default=-1)
+        return levels[name]
+
+    for name in stages:
+        level(name)
+    return levels
+
+
+def run_stages(stages, done=(), on_done=None):
+    """Runs the stages graph, each stage as soon as its dependencies are
+    finished. After a failure no new stage is started and the running
+    ones are waited.
+
+    Keyword Arguments:
+    stages  -- dict, stage name -> (function, list of dependencies)
+               Dependencies not in stages are ignored.
+    done    -- names of the stages already finished
+    on_done -- function called with the name of each finished stage
+
+    Returns
+    -------
+    out : dict, failed stage name -> exception (any Exception)
+    """
+    finished = set(done)
+    failed = {}
+    running = {}
+    with ThreadPoolExecutor(max_workers=max(1, len(stages))) as pool:
+        while True:
+            if not failed:
+                for name, (function, deps) in stages.items():
+                    if name in finished or name in running:
+                        continue
+                    if all(dep in finished for dep in deps
+                           if dep in stages):
+                        running[name] = pool.submit(function)
+            if not running:
+                break
+            wait(running.values(), return_when=FIRST_COMPLETED)
+            for name, future in list(running.items()):
+                if not future.done():
+                    continue
+                del running[name]
+                try:
+                    future.result()
+                # any error fails the stage, the finished ones stay in
+                # the journal for --resume
+                except Exception as err:
+                    failed[name] = err
+                    continue
+                finished.add(name)
+                if on_done is not None:
+                    on_done(name)
+    return failed
 
 
 if __name__ == '__main__':
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# ------------------------------
+# Name:     fake_tool.py
+# Purpose:  Stub of mamba, conda, apt, dpkg-query and wget for the
+#           SEISbio benchmarks
+#
+# Licence:     GNU GENERAL PUBLIC LICENSE, Version 3, 29 June 2007
+# ------------------------------
+"""Stub of the external tools called by InstallSEISbio.py.
+
+The tool is the name of the link used to call this file (mamba, conda,
+apt, apt-get, dpkg-query, wget). mamba and conda keep the state of the
+fake distribution in the prefix (envs/<name>/conda-meta records), so the
+installer sees the envs it created.
+
+Settings (environment variables):
+
+    SEISBIO_FAKE_CALLS         file where each call is appended
+    SEISBIO_FAKE_LATENCY       seconds of each call [0]
+    SEISBIO_FAKE_FAIL_RATE     probability of failure of the install
+                               commands (create, install, update, apt) [0]
+    SEISBIO_FAKE_OUTPUT_LINES  output lines of the install commands [10]
+    SEISBIO_FAKE_INSTALLED     packages reported by dpkg-query [500]
+    SEISBIO_FAKE_CHANNEL       directory of the file:// package URLs of
+                               --dry-run --json, the tarballs are written
+                               there. Every env also needs the
+                               SHARED_DEPS packages.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import hashlib
+from pathlib import Path
+
+LATENCY = float(os.environ.get('SEISBIO_FAKE_LATENCY', 0))
+FAIL_RATE = float(os.environ.get('SEISBIO_FAKE_FAIL_RATE', 0))
+OUTPUT_LINES = int(os.environ.get('SEISBIO_FAKE_OUTPUT_LINES', 10))
+INSTALLED = int(os.environ.get('SEISBIO_FAKE_INSTALLED', 500))
+CHANNEL = os.environ.get('SEISBIO_FAKE_CHANNEL')
+SHARED_DEPS = ['python=3.12.4', 'openssl=3.3.1', 'libzlib=1.3.1']
+
+
+def record_call(tool, args):
+    """Appends the call to SEISBIO_FAKE_CALLS"""
+    calls = os.environ.get('SEISBIO_FAKE_CALLS')
+    if calls:
+        with open(calls, 'a') as out:
+            out.write(' '.join([tool] + args) + '\n')
+
+
+def work(tool, what):
+    """Latency, output and random failure of an install command"""
+    time.sleep(LATENCY)
+    for i in range(OUTPUT_LINES):
+        print(f'{tool}: {what} step {i} ' + '.' * 60)
+    if random.random() < FAIL_RATE:
+        print(f'{tool}: simulated failure of {what}', file=sys.stderr)
+        sys.exit(1)
+
+
+def root_prefix():
+    """Distribution prefix, the link is <prefix>/bin/<tool>"""
+    return Path(os.path.abspath(sys.argv[0])).parent.parent
+
+
+def meta_records(prefix):
+    """name -> version of the conda-meta records of prefix"""
+    packages = {}
+    meta_dir = Path(prefix)/'conda-meta'
+    if meta_dir.is_dir():
+        for meta in meta_dir.glob('*.json'):
+            name, version, _ = meta.stem.rsplit('-', 2)
+            packages[name] = version
+    return packages
+
+
+def install_packages(prefix, packages):
+    """Writes the conda-meta record and the command of each package"""
+    prefix = Path(prefix)
+    (prefix/'conda-meta').mkdir(parents=True, exist_ok=True)
+    (prefix/'bin').mkdir(exist_ok=True)
+    for pkg in packages:
+        name, _, version = pkg.partition('=')
+        version = version.lstrip('=') or '1.0'
+        for old in (prefix/'conda-meta').glob(f'{name}-*-0.json'):
+            if old.stem.rsplit('-', 2)[0] == name:
+                old.unlink()
+        record = {'name': name, 'version': version,
+                  'files': [f'bin/{name}']}
+        (prefix/'conda-meta'/f'{name}-{version}-0.json').write_text(
+            json.dumps(record))
+        command = prefix/'bin'/name
+        command.write_text(f'#!/bin/sh\necho {name} {version}\n')
+        command.chmod(0o755)
+
+
+def explicit_packages(lockfile):
+    """Packages of an explicit lockfile (URL lines)"""
+    packages = []
+    for line in Path(lockfile).read_text().splitlines():
+        if line.startswith(('http', 'file:')):
+            fname = line.split('#')[0].split('/')[-1]
+            stem = fname.rsplit('.tar.bz2', 1)[0].rsplit('.conda', 1)[0]
+            name, version, _ = stem.rsplit('-', 2)
+            packages.append(f'{name}={version}')
+    return packages
+
+
+def fetch_actions(packages):
+    """--dry-run --json output, the packages (and SHARED_DEPS) to fetch
+    from CHANNEL"""
+    fetch = []
+    for pkg in packages + SHARED_DEPS:
+        name, _, version = pkg.partition('=')
+        version = version.lstrip('=') or '1.0'
+        fname = f'{name}-{version}-0.conda'
+        tarball = Path(CHANNEL)/fname
+        if not tarball.exists():
+            tarball.write_bytes(fname.encode() * 1000)
+        fetch.append({'url': f'file://{tarball}', 'fn': fname,
+                      'md5': hashlib.md5(tarball.read_bytes()).hexdigest()})
+    print(json.dumps({'actions': {'FETCH': fetch, 'LINK': []},
+                      'success': True}))
+
+
+def conda(tool, args):
+    """mamba and conda subcommands used by the installer"""
+    root = root_prefix()
+    command = args[0] if args else ''
+    options, packages = {}, []
+    tokens = iter(args[1:])
+    for token in tokens:
+        if token in ('-n', '-p', '-c', '--file'):
+            options.setdefault(token, []).append(next(tokens))
+        elif not token.startswith('-'):
+            packages.append(token)
+    flags = set(args)
+    if command == 'info':
+        print(f'     base environment : {root}  (writable)')
+    elif command == 'init':
+        print('no change')
+    elif command == 'clean':
+        time.sleep(LATENCY)
+    elif command == 'list':
+        prefix = options.get('-p', [root])[0]
+        records = meta_records(prefix)
+        if '--json' in flags:
+            print(json.dumps([{'name': name, 'version': version}
+                              for name, version in sorted(records.items())]))
+        else:
+            print('@EXPLICIT')
+            for name, version in sorted(records.items()):
+                print(f'https://fake.channel/linux-64/{name}-{version}-0'
+                      '.conda#0123456789abcdef0123456789abcdef')
+    elif command == 'env' and packages[:1] == ['list']:
+        envs = [str(root)]
+        if (root/'envs').is_dir():
+            envs += [str(env) for env in sorted((root/'envs').iterdir())]
+        print(json.dumps({'envs': envs}))
+    elif command == 'env' and packages[:1] == ['remove']:
+        time.sleep(LATENCY)
+        shutil.rmtree(root/'envs'/options['-n'][0], ignore_errors=True)
+    elif command in ('create', 'install', 'update') and '--dry-run' in flags:
+        time.sleep(LATENCY)
+        if CHANNEL:
+            fetch_actions(packages)
+        else:
+            print(json.dumps({'actions': {}, 'success': True}))
+    elif command in ('create', 'install', 'update'):
+        if '-n' in options:
+            prefix = root/'envs'/options['-n'][0]
+        else:
+            prefix = Path(options.get('-p', [root])[0])
+        for lockfile in options.get('--file', []):
+            packages += explicit_packages(lockfile)
+        work(tool, f"{command} {prefix.name}")
+        install_packages(prefix, packages)
+    else:
+        print(f'{tool}: unknown command {command}', file=sys.stderr)
+        sys.exit(2)
+
+
+def apt(tool, args):
+    """apt and apt-get, only output, latency and failures"""
+    work(tool, ' '.join(args[:1]))
+
+
+def dpkg_query(tool, args):
+    """dpkg-query -W: SEISBIO_FAKE_INSTALLED installed packages"""
+    for i in range(INSTALLED):
+        print(f'fakepkg{i}\tii \t')
+
+
+def wget(tool, args):
+    """Writes an empty file with the name of the URL (or -O)"""
+    time.sleep(LATENCY)
+    urls = [arg for arg in args if '://' in arg]
+    output = None
+    if '-O' in args:
+        output = args[args.index('-O') + 1]
+    for url in urls:
+        Path(output or url.split('/')[-1]).write_bytes(b'')
+
+
+TOOLS = {'mamba': conda, 'conda': conda, 'apt': apt, 'apt-get': apt,
+         'dpkg-query': dpkg_query, 'wget': wget}
+
+
+def main():
+    tool = Path(sys.argv[0]).name
+    args = sys.argv[1:]
+    record_call(tool, args)
+    TOOLS[tool](tool, args)
+
+
+if __name__ == '__main__':
+    main()
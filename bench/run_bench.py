@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# ------------------------------
+# Name:     run_bench.py
+# Purpose:  Offline benchmark of the SEISbio installer orchestration
+#
+# Licence:     GNU GENERAL PUBLIC LICENSE, Version 3, 29 June 2007
+# ------------------------------
+"""Offline benchmark of the SEISbio installer orchestration.
+
+InstallSEISbio.py runs end to end (local installation, --home-root in a
+temporary directory) against stub mamba, conda, apt, dpkg-query and wget
+(see fakes/fake_tool.py), no root, network or real distribution needed.
+For each env file size the installer runs twice:
+
+    fresh   empty home: download, install, update, base and envs
+    rerun   same home: every env is already installed and skipped
+
+and the Debian step (dpkg-query + apt) is measured on its own. The report
+has the wall time, the number of stub calls (subprocesses) and the peak
+RSS of the installer (or of its biggest subprocess).
+
+    python bench/run_bench.py --sizes 10 100 1000 -j 4 --latency 0.05
+"""
+
+import os
+import sys
+import json
+import time
+import hashlib
+import getpass
+import argparse
+import tempfile
+import shutil
+from pathlib import Path
+from subprocess import Popen
+from subprocess import PIPE
+from subprocess import STDOUT
+
+BENCH_DIR = Path(__file__).parent.absolute()
+INSTALLER = BENCH_DIR.parent/'InstallSEISbio.py'
+FAKE_TOOL = BENCH_DIR/'fakes'/'fake_tool.py'
+TOOLS = ['mamba', 'conda', 'apt', 'apt-get', 'dpkg-query', 'wget']
+DIST_INSTALLER = 'Miniforge3-Linux-x86_64.sh'
+
+
+def arguments():
+    """Benchmark settings"""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.
+                                     RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', nargs='+', type=int,
+                        default=[10, 100, 1000],
+                        help='Env file sizes (entries). [10 100 1000]')
+    parser.add_argument('-j', '--jobs', default=4, type=int,
+                        help='Installer --jobs. [4]')
+    parser.add_argument('--latency', default=0.0, type=float,
+                        help='Seconds of each stub call. [0]')
+    parser.add_argument('--fail-rate', default=0.0, type=float,
+                        help='Failure probability of the stub install '
+                        'commands. [0]')
+    parser.add_argument('--output-lines', default=10, type=int,
+                        help='Output lines of the stub install commands. '
+                        '[10]')
+    parser.add_argument('--prefetch', default=False, action='store_true',
+                        help='Installer --prefetch, the stub dry-runs fetch '
+                        'from a file:// channel.')
+    parser.add_argument('--json', default=None,
+                        help='Write the results to this JSON file.')
+    parser.add_argument('--keep', default=False, action='store_true',
+                        help='Keep the temporary directories (logs).')
+    return parser.parse_args()
+
+
+def write_env_file(path, size):
+    """Env file with size entries, some of them pinned or with many
+    packages like virtual_envs.txt"""
+    with open(path, 'w') as out:
+        out.write('# benchmark env file\n')
+        for i in range(size):
+            if i % 10 == 3:
+                out.write(f'benchpkg{i:04d}=2.1\n')
+            elif i % 10 == 7:
+                out.write(f'benchpkg{i:04d} benchdep{i:04d} -c bench\n')
+            else:
+                out.write(f'benchpkg{i:04d}\n')
+
+
+def write_fake_installer(mirror):
+    """Installer that makes a prefix with the mamba and conda stubs, and
+    its published checksum"""
+    mirror.mkdir(parents=True)
+    installer = mirror/DIST_INSTALLER
+    installer.write_text('#!/bin/bash\n'
+                         '# fake distribution installer: -b -p <prefix>\n'
+                         'prefix="$3"\n'
+                         'mkdir -p "$prefix/bin" "$prefix/pkgs" '
+                         '"$prefix/conda-meta" "$prefix/envs"\n'
+                         f'ln -s "{FAKE_TOOL}" "$prefix/bin/mamba"\n'
+                         f'ln -s "{FAKE_TOOL}" "$prefix/bin/conda"\n'
+                         f'ln -s "{sys.executable}" "$prefix/bin/python"\n')
+    digest = hashlib.sha256(installer.read_bytes()).hexdigest()
+    (mirror/(DIST_INSTALLER + '.sha256')).write_text(
+        f'{digest}  {DIST_INSTALLER}\n')
+
+
+def fake_bin(path):
+    """Directory with the stubs for PATH"""
+    path.mkdir(parents=True)
+    for tool in TOOLS:
+        os.symlink(FAKE_TOOL, path/tool)
+    return path
+
+
+def measure(cmd, env, log, stdin=b''):
+    """Runs cmd and returns (exit status, wall seconds, peak RSS MB)"""
+    start = time.time()
+    with open(log, 'ab') as out:
+        proc = Popen(cmd, stdin=PIPE, stdout=out, stderr=STDOUT, env=env)
+        proc.stdin.write(stdin)
+        proc.stdin.close()
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+    wall = time.time() - start
+    # ru_maxrss is in KB on Linux
+    return proc.returncode, wall, usage.ru_maxrss / 1024
+
+
+def count_calls(calls):
+    """Stub calls recorded since the last count, the file is emptied"""
+    if not calls.exists():
+        return 0
+    count = len(calls.read_text().splitlines())
+    calls.write_text('')
+    return count
+
+
+def bench_size(size, args, workdir):
+    """Fresh and rerun installations with an env file of size entries"""
+    home_root = workdir/'home'
+    user_home = home_root/getpass.getuser()
+    user_home.mkdir(parents=True)
+    mirror = workdir/'mirror'
+    write_fake_installer(mirror)
+    envfile = workdir/f'envs-{size}.txt'
+    write_env_file(envfile, size)
+    calls = workdir/'calls.log'
+    env = dict(os.environ,
+               PATH=f"{fake_bin(workdir/'bin')}:{os.environ['PATH']}",
+               SEISBIO_FAKE_CALLS=str(calls),
+               SEISBIO_FAKE_LATENCY=str(args.latency),
+               SEISBIO_FAKE_FAIL_RATE=str(args.fail_rate),
+               SEISBIO_FAKE_OUTPUT_LINES=str(args.output_lines))
+    env.pop('CONDA_PKGS_DIRS', None)
+    cmd = [sys.executable, str(INSTALLER), 'install', '--local',
+           '--home-root', str(home_root), '--mirror', f'file://{mirror}',
+           '-f', str(envfile), '-j', str(args.jobs)]
+    if args.prefetch:
+        channel = workdir/'channel'
+        channel.mkdir()
+        env['SEISBIO_FAKE_CHANNEL'] = str(channel)
+        cmd.append('--prefetch')
+    results = []
+    # rerun: answer no to the base update question
+    for run, stdin in (('fresh', b''), ('rerun', b'n\n')):
+        status, wall, peak = measure(cmd, env, workdir/'installer.log',
+                                     stdin=stdin)
+        results.append({'size': size, 'run': run, 'exit': status,
+                        'seconds': wall, 'calls': count_calls(calls),
+                        'peak_mb': peak})
+    return results
+
+
+def bench_debian(args, workdir):
+    """debian_install_bioinfo alone: one dpkg-query and one apt call"""
+    workdir.mkdir(parents=True)
+    calls = workdir/'calls.log'
+    env = dict(os.environ,
+               PATH=f"{fake_bin(workdir/'bin')}:{os.environ['PATH']}",
+               SEISBIO_FAKE_CALLS=str(calls),
+               SEISBIO_FAKE_LATENCY=str(args.latency),
+               SEISBIO_FAKE_FAIL_RATE=str(args.fail_rate),
+               SEISBIO_FAKE_OUTPUT_LINES=str(args.output_lines),
+               PYTHONPATH=str(INSTALLER.parent))
+    code = ('import InstallSEISbio; '
+            f'InstallSEISbio.debian_install_bioinfo(logs={str(workdir)!r})')
+    status, wall, peak = measure([sys.executable, '-c', code], env,
+                                 workdir/'debian.log')
+    return {'size': '-', 'run': 'debian', 'exit': status, 'seconds': wall,
+            'calls': count_calls(calls), 'peak_mb': peak}
+
+
+def print_results(results):
+    """Results table"""
+    print(f"{'entries':>8} {'run':>7} {'exit':>5} {'seconds':>9} "
+          f"{'ms/env':>8} {'calls':>7} {'peak MB':>8}")
+    for res in results:
+        per_env = '-'
+        if isinstance(res['size'], int):
+            per_env = f"{1000 * res['seconds'] / res['size']:.1f}"
+        print(f"{res['size']:>8} {res['run']:>7} {res['exit']:>5} "
+              f"{res['seconds']:9.2f} {per_env:>8} {res['calls']:>7} "
+              f"{res['peak_mb']:8.1f}")
+
+
+def main():
+    args = arguments()
+    workdir = Path(tempfile.mkdtemp(prefix='seisbio-bench-'))
+    results = []
+    try:
+        for size in args.sizes:
+            print(f'[BENCH] {size} entries')
+            results += bench_size(size, args, workdir/f'size-{size}')
+        print('[BENCH] debian')
+        results.append(bench_debian(args, workdir/'debian'))
+    finally:
+        if args.keep:
+            print(f'[BENCH] Logs kept in {workdir}')
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    print_results(results)
+    if args.json:
+        Path(args.json).write_text(json.dumps(
+            {'created': time.time(),
+             'settings': {'jobs': args.jobs, 'latency': args.latency,
+                          'prefetch': args.prefetch,
+                          'fail_rate': args.fail_rate,
+                          'output_lines': args.output_lines},
+             'results': results}, indent=1))
+        print(f'[BENCH] Results: {args.json}')
+    if any(res['exit'] != 0 for res in results) and not args.fail_rate:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()